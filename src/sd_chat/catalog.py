@@ -0,0 +1,177 @@
+import json
+import difflib
+from collections import OrderedDict
+
+from .settings import CheckPointSettings, LoraSettings
+from .settings_store import SettingsStore
+from .model_registry import ModelRegistry
+
+class CheckpointIndexEntry:
+    def __init__(self, key: str, settings: CheckPointSettings):
+        self.key = key
+        self.settings = settings
+        self.search_text = '\n'.join([key, settings.name, settings.caption]).lower()
+        self.lora_search_texts = {}
+        for lora_key, lora_settings in settings.loras.items():
+            self.lora_search_texts[lora_key] = '\n'.join([lora_key, lora_settings.name, lora_settings.caption] + lora_settings.trigger_words).lower()
+        self.lora_lookup = {}
+        for lora_key, lora_settings in settings.loras.items():
+            self.lora_lookup[lora_key] = lora_settings
+        for lora_key, lora_settings in settings.loras.items():
+            self.lora_lookup.setdefault(lora_settings.name, lora_settings)
+            self.lora_lookup.setdefault(lora_key.lower(), lora_settings)
+            self.lora_lookup.setdefault(lora_settings.name.lower(), lora_settings)
+
+    def find_lora(self, name: str, fuzzy: bool = False) -> LoraSettings | None:
+        if name in self.lora_lookup:
+            return self.lora_lookup[name]
+        if name.lower() in self.lora_lookup:
+            return self.lora_lookup[name.lower()]
+        if fuzzy:
+            matches = difflib.get_close_matches(name.lower(), self.lora_lookup.keys(), n=1, cutoff=0.8)
+            if len(matches) > 0:
+                return self.lora_lookup[matches[0]]
+        return None
+
+class ModelCatalog:
+    def __init__(self, store: SettingsStore, max_cached_lists: int = 32):
+        self.store = store
+        self.max_cached_lists = max_cached_lists
+        self.cached_lists = OrderedDict()
+        self.entries = {}
+        self.checkpoint_lookup = {}
+        self.version = 0
+        store.add_listener(self.__on_settings_changed)
+        store.get()
+        self.__rebuild()
+
+    def __on_settings_changed(self, data: dict):
+        self.__rebuild()
+
+    def __rebuild(self):
+        # The store hands out the same CheckPointSettings object for an
+        # unchanged checkpoint, so only edited entries are re-indexed.
+        entries = {}
+        for checkpoint_key, checkpoint_settings in self.store.checkpoints.items():
+            if checkpoint_key in self.entries and self.entries[checkpoint_key].settings is checkpoint_settings:
+                entries[checkpoint_key] = self.entries[checkpoint_key]
+            else:
+                entries[checkpoint_key] = CheckpointIndexEntry(checkpoint_key, checkpoint_settings)
+        checkpoint_lookup = {}
+        for checkpoint_key in entries.keys():
+            checkpoint_lookup[checkpoint_key] = checkpoint_key
+        for checkpoint_key, entry in entries.items():
+            checkpoint_lookup.setdefault(entry.settings.name, checkpoint_key)
+            checkpoint_lookup.setdefault(checkpoint_key.lower(), checkpoint_key)
+            checkpoint_lookup.setdefault(entry.settings.name.lower(), checkpoint_key)
+        self.entries = entries
+        self.checkpoint_lookup = checkpoint_lookup
+        self.version += 1
+
+    def find_checkpoint(self, name: str, fuzzy: bool = False) -> CheckpointIndexEntry | None:
+        self.store.get()
+        if name is None:
+            return None
+        checkpoint_lookup = self.checkpoint_lookup
+        if name in checkpoint_lookup:
+            return self.entries[checkpoint_lookup[name]]
+        if name.lower() in checkpoint_lookup:
+            return self.entries[checkpoint_lookup[name.lower()]]
+        if fuzzy:
+            matches = difflib.get_close_matches(name.lower(), checkpoint_lookup.keys(), n=1, cutoff=0.8)
+            if len(matches) > 0:
+                return self.entries[checkpoint_lookup[matches[0]]]
+        return None
+
+    def find_loras(self, checkpoint_entry: CheckpointIndexEntry, names: list, fuzzy: bool = False) -> list:
+        ret = []
+        for name in names:
+            lora_settings = checkpoint_entry.find_lora(name, fuzzy)
+            if lora_settings is not None:
+                ret.append(lora_settings)
+        return ret
+
+    def list_models(self, model_registry: ModelRegistry | None, checkpoint_name: str | None = None, base_model: str | None = None, installed_only: bool = False, query: str | None = None, page: int = 0, page_size: int = 0, compact: bool = False) -> dict:
+        self.store.get()
+        entries = self.entries
+        if checkpoint_name is not None and checkpoint_name != '':
+            checkpoint_entry = self.find_checkpoint(checkpoint_name)
+            entries = {checkpoint_entry.key: checkpoint_entry} if checkpoint_entry is not None else {}
+        if base_model is not None and base_model != '':
+            base_model = base_model.lower()
+        else:
+            base_model = None
+        if query is not None and query != '':
+            query = query.lower()
+        else:
+            query = None
+
+        ret = {}
+        for checkpoint_key, entry in entries.items():
+            checkpoint_settings = entry.settings
+            if model_registry is not None:
+                installed = model_registry.is_installed(checkpoint_settings.name)
+            else:
+                installed = not checkpoint_settings.not_installed
+            if installed_only and not installed:
+                continue
+            if base_model is not None and checkpoint_settings.base_model.lower() != base_model:
+                continue
+            lora_keys = []
+            for lora_key, lora_settings in checkpoint_settings.loras.items():
+                if base_model is not None and lora_settings.base_model != '' and lora_settings.base_model.lower() != base_model:
+                    continue
+                if query is not None and not query in entry.lora_search_texts[lora_key]:
+                    continue
+                lora_keys.append(lora_key)
+            if query is not None and len(lora_keys) <= 0 and not query in entry.search_text:
+                continue
+
+            loras_total = len(lora_keys)
+            if page_size > 0:
+                lora_keys = lora_keys[page * page_size:(page + 1) * page_size]
+
+            if compact:
+                ret[checkpoint_key] = {
+                    'name': checkpoint_settings.name,
+                    'base_model': checkpoint_settings.base_model,
+                    'installed': installed,
+                    'loras': lora_keys,
+                }
+            else:
+                ret[checkpoint_key] = {
+                    'name': checkpoint_settings.name,
+                    'caption': checkpoint_settings.caption,
+                    'base_model': checkpoint_settings.base_model,
+                    'installed': installed,
+                    'loras': {},
+                }
+                for lora_key in lora_keys:
+                    lora_settings = checkpoint_settings.loras[lora_key]
+                    ret[checkpoint_key]['loras'][lora_key] = {
+                        'name': lora_settings.name,
+                        'trigger_words': lora_settings.trigger_words,
+                        'caption': lora_settings.caption,
+                    }
+            if page_size > 0:
+                ret[checkpoint_key]['loras_total'] = loras_total
+        return ret
+
+    def list_models_json(self, model_registry: ModelRegistry | None, *args) -> str:
+        # Memoized on the catalog and registry versions, so the tree is only
+        # rebuilt and serialized again after settings.json or the model
+        # directory changes.
+        self.store.get()
+        if model_registry is not None:
+            model_registry.rescan()
+            key = (self.version, model_registry.root_path, model_registry.version) + args
+        else:
+            key = (self.version, None, None) + args
+        if key in self.cached_lists:
+            self.cached_lists.move_to_end(key)
+            return self.cached_lists[key]
+        ret = json.dumps(self.list_models(model_registry, *args), ensure_ascii=False)
+        self.cached_lists[key] = ret
+        while len(self.cached_lists) > self.max_cached_lists:
+            self.cached_lists.popitem(last=False)
+        return ret
@@ -2,16 +2,33 @@ import json
 import os
 import uuid
 import urllib.parse
-import glob
-import hashlib
-import aiohttp
 import asyncio
 
-from .util import get_path_settings_file
-
-async def civitai_fetch(url):
-    with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-        settings_dict = json.load(f)
+from .settings_store import settings_store
+from .hash_cache import HashCache
+from .civitai_cache import CivitaiCache, CachedResponse
+from .http_client import http_client, get_http_session
+from .download import DownloadManager, DownloadTask
+from .model_registry import get_model_registry
+from .util import get_path_data_file
+
+CIVITAI_API_URL = 'https://civitai.com/api/v1'
+
+CACHE_TTL_DEFAULTS = {
+    'model': 24 * 3600,
+    'version': 24 * 3600,
+    'search': 3600,
+}
+
+hash_cache = None
+def init_hash_cache():
+    global hash_cache
+    if hash_cache is not None:
+        return
+    hash_cache = HashCache(get_path_data_file('model_hashes.db'))
+
+def civitai_headers():
+    settings_dict = settings_store.get()
     headers = {}
     if 'civitai_api_key' in settings_dict:
         headers = {"Authorization": f"Bearer {settings_dict['civitai_api_key']}"}
@@ -19,23 +36,89 @@ async def civitai_fetch(url):
         civitai_api_key = os.environ.get('CIVITAI_API_KEY')
         if civitai_api_key is not None:
             headers = {"Authorization": f"Bearer {civitai_api_key}"}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
+    return headers
+
+civitai_cache = None
+def init_civitai_cache():
+    global civitai_cache
+    if civitai_cache is not None:
+        return
+    settings_dict = settings_store.get()
+    cache_settings = settings_dict['civitai_cache'] if 'civitai_cache' in settings_dict else {}
+    civitai_cache = CivitaiCache(get_path_data_file('civitai_cache.db'), cache_settings.get('max_entries', 4096))
+
+def get_cache_ttl(kind: str) -> float:
+    settings_dict = settings_store.get()
+    cache_settings = settings_dict['civitai_cache'] if 'civitai_cache' in settings_dict else {}
+    return cache_settings.get(f'{kind}_ttl', CACHE_TTL_DEFAULTS[kind])
+
+inflight_fetches = {}
+
+async def civitai_fetch(url, ttl: float | None = None):
+    # With a ttl, responses are kept on disk. A fresh entry is served without
+    # a request; a stale one is revalidated with its ETag/Last-Modified.
+    cached = None
+    if ttl is not None:
+        init_civitai_cache()
+        cached = civitai_cache.get(url)
+        if cached is not None and cached.is_fresh(ttl):
+            return cached.body
+
+    # Concurrent fetches of the same URL share one request. The shield keeps
+    # a cancelled caller from cancelling it for the others.
+    key = (asyncio.get_running_loop(), url)
+    fetch_task = inflight_fetches.get(key)
+    if fetch_task is None:
+        fetch_task = asyncio.ensure_future(civitai_fetch_uncached(url, ttl, cached))
+        inflight_fetches[key] = fetch_task
+        fetch_task.add_done_callback(lambda _: inflight_fetches.pop(key, None))
+    return await asyncio.shield(fetch_task)
+
+async def civitai_fetch_uncached(url, ttl: float | None, cached: CachedResponse | None):
+    headers = civitai_headers()
+    if cached is not None:
+        if cached.etag is not None:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified is not None:
+            headers['If-Modified-Since'] = cached.last_modified
+    async with get_http_session().get(url, headers=headers, timeout=http_client.get_request_timeout()) as response:
+        if response.status == 304 and cached is not None:
+            civitai_cache.touch(url)
+            return cached.body
+        response.raise_for_status()
+        body = await response.json()
+        if ttl is not None:
+            civitai_cache.put(url, body, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return body
 
 class CivitaiAPI():
-    model_dict = {}
-    version_dict = {}
-    download_ids = []
-    finished_ids = []
+    download_manager = None
+    prefetch_tasks = set()
+
+    def __init_download_manager(self):
+        if self.download_manager is not None:
+            return
+        settings_dict = settings_store.get()
+        download_settings = settings_dict['downloads'] if 'downloads' in settings_dict else {}
+        CivitaiAPI.download_manager = DownloadManager(
+            max_concurrent=download_settings.get('max_concurrent', 2),
+            max_retries=download_settings.get('max_retries', 3),
+            retry_backoff=download_settings.get('retry_backoff', 2.0),
+            segments=download_settings.get('segments', 1),
+            min_segment_mb=download_settings.get('min_segment_mb', 64),
+        )
+
+    async def get_model(self, model_id: int) -> dict:
+        return await civitai_fetch(f'{CIVITAI_API_URL}/models/{model_id}', get_cache_ttl('model'))
+
+    async def get_version(self, version_id: int) -> dict:
+        return await civitai_fetch(f'{CIVITAI_API_URL}/model-versions/{version_id}', get_cache_ttl('version'))
 
     async def get_model_versions(self, model_id: int) -> list:
-        if not str(model_id) in self.model_dict:
-           self.model_dict[str(model_id)] = await civitai_fetch(f'https://civitai.com/api/v1/models/{model_id}')
+        model = await self.get_model(model_id)
 
         ret_list = []
-        for version in self.model_dict[str(model_id)]['modelVersions']:
-            self.version_dict[str(version['id'])] = version
+        for version in model['modelVersions']:
             if 'description' in version:
                 ret_dict = {
                     'version_id': version['id'],
@@ -53,121 +136,105 @@ class CivitaiAPI():
         return ret_list
 
     async def get_model_info(self, version_id: int):
-        if not str(version_id) in self.version_dict or not 'modelId' in self.version_dict[str(version_id)] or not self.version_dict[str(version_id)] in self.model_dict:
-            self.version_dict[str(version_id)] = await civitai_fetch(f'https://civitai.com/api/v1/model-versions/{version_id}')
-            self.model_dict[str(self.version_dict[str(version_id)]['modelId'])] = await civitai_fetch(f'https://civitai.com/api/v1/models/{self.version_dict[str(version_id)]['modelId']}')
+        version = await self.get_version(version_id)
+        model = await self.get_model(version['modelId'])
 
-        model_id = str(self.version_dict[str(version_id)]['modelId'])
         ret = {}
-        ret['model_name'] = self.model_dict[model_id]['name']
-        ret['model_description'] = self.model_dict[model_id]['description']
-        ret['version_name'] = self.version_dict[str(version_id)]['name']
-        if 'description' in self.version_dict[str(version_id)]:
-            ret['version_description'] = self.version_dict[str(version_id)]['description']
-        ret['type'] = self.model_dict[model_id]['type']
-        ret['version_base_model'] = self.version_dict[str(version_id)]['baseModel']
+        ret['model_name'] = model['name']
+        ret['model_description'] = model['description']
+        ret['version_name'] = version['name']
+        if 'description' in version:
+            ret['version_description'] = version['description']
+        ret['type'] = model['type']
+        ret['version_base_model'] = version['baseModel']
 
         return ret
 
-    def __rewrite_settings(self, version_id: int, base_model_name: str, file_name: str, caption: str, weight: float):
-        with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-            settings_dict = json.load(f)
+    def __rewrite_settings(self, version: dict, base_model_name: str, file_name: str, caption: str, weight: float):
+        settings_dict = settings_store.load_for_update()
 
-        if self.version_dict[str(version_id)]['model']['type'] == 'Checkpoint':
-            name = self.version_dict[str(version_id)]['model']['name']
+        if version['model']['type'] == 'Checkpoint':
+            name = version['model']['name']
             loop = 1
             while name in settings_dict['checkpoints']:
-                name = f'{self.version_dict[str(version_id)]['model']['name']} ({loop})'
+                name = f'{version['model']['name']} ({loop})'
                 loop += 1
             settings_dict['checkpoints'][name] = {}
             settings_dict['checkpoints'][name]['name'] = os.path.splitext(file_name)[0]
             settings_dict['checkpoints'][name]['caption'] = caption
-            settings_dict['checkpoints'][name]['base_model'] = self.version_dict[str(version_id)]['base_model']
-        elif self.version_dict[str(version_id)]['model']['type'] == 'LORA':
-            name = self.version_dict[str(version_id)]['model']['name']
+            settings_dict['checkpoints'][name]['base_model'] = version['baseModel']
+        elif version['model']['type'] == 'LORA':
+            name = version['model']['name']
             loop = 1
             while name in settings_dict['checkpoints'][base_model_name]['loras']:
-                name = f'{self.version_dict[str(version_id)]['model']['name']} ({loop})'
+                name = f'{version['model']['name']} ({loop})'
                 loop += 1
             settings_dict['checkpoints'][base_model_name]['loras'][name] = {}
             settings_dict['checkpoints'][base_model_name]['loras'][name]['name'] = os.path.splitext(file_name)[0]
-            settings_dict['checkpoints'][base_model_name]['loras'][name]['trigger_words'] = self.version_dict[str(version_id)]['trainedWords']
+            settings_dict['checkpoints'][base_model_name]['loras'][name]['trigger_words'] = version['trainedWords']
             settings_dict['checkpoints'][base_model_name]['loras'][name]['weight'] = weight
             settings_dict['checkpoints'][base_model_name]['loras'][name]['caption'] = caption
-            settings_dict['checkpoints'][base_model_name]['loras'][name]['base_model'] = self.version_dict[str(version_id)]['baseModel']
+            settings_dict['checkpoints'][base_model_name]['loras'][name]['base_model'] = version['baseModel']
 
-        with open(get_path_settings_file('settings.json', new_file=True), 'w', encoding="utf-8") as f:
-            json.dump(settings_dict, f, indent=2)
+        settings_store.save(settings_dict)
 
     async def install_model(self, checkpoints_path: str | None, loras_path: str | None, version_id: int | None, caption: str, base_model_name: str = None, weight: float = 1.0):
-        with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-            settings_dict = json.load(f)
+        settings_dict = settings_store.get()
 
         if 'apis' in settings_dict and 'webui_client' in settings_dict['apis'] and 'host' in settings_dict['apis']['webui_client']:
             if settings_dict['apis']['webui_client']['host'] != 'localhost' and settings_dict['apis']['webui_client']['host'] != '127.0.0.1':
                 return None
 
+        version = None
         if version_id is not None:
-            if not str(version_id) in self.version_dict:
-                self.version_dict[str(version_id)] = await civitai_fetch(f'https://civitai.com/api/v1/model-versions/{version_id}')
+            version = await self.get_version(version_id)
 
-            if 'model' in self.version_dict[str(version_id)] and 'type' in self.version_dict[str(version_id)]['model'] and self.version_dict[str(version_id)]['model']['type'] == 'LORA' and not base_model_name in settings_dict['checkpoints']:
+            if 'model' in version and 'type' in version['model'] and version['model']['type'] == 'LORA' and not base_model_name in settings_dict['checkpoints']:
                 return None
 
-        if version_id is None or 'model' in self.version_dict[str(version_id)] and 'type' in self.version_dict[str(version_id)]['model'] and self.version_dict[str(version_id)]['model']['type'] == 'LORA' and 'not_installed' in settings_dict['checkpoints'][base_model_name]:
+        if version_id is None or 'model' in version and 'type' in version['model'] and version['model']['type'] == 'LORA' and 'not_installed' in settings_dict['checkpoints'][base_model_name]:
             if 'checkpoints_path' in settings_dict:
                 download_checkpoints_path = settings_dict['checkpoints_path']
             elif checkpoints_path is not None:
                 download_checkpoints_path = checkpoints_path
             else:
                 download_checkpoints_path = os.path.join(settings_dict['save_path'], 'models', 'StableDiffusion')
-            if os.path.isfile(os.path.join(download_checkpoints_path, settings_dict['checkpoints'][base_model_name]['name'] + '.safetensors')):
+            if get_model_registry(download_checkpoints_path).is_installed(settings_dict['checkpoints'][base_model_name]['name']):
                 if 'not_installed' in settings_dict['checkpoints'][base_model_name]:
+                    settings_dict = settings_store.load_for_update()
                     del settings_dict['checkpoints'][base_model_name]['not_installed']
-                    with open(get_path_settings_file('settings.json', new_file=True), 'w', encoding="utf-8") as f:
-                        json.dump(settings_dict, f, indent=2)
+                    settings_store.save(settings_dict)
 
         download_id = str(uuid.uuid4())
 
-        async def download_task_main(version_id: int):
-            with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-                settings_dict = json.load(f)
+        async def download_task_main(task: DownloadTask, version_id: int):
+            settings_dict = settings_store.get()
+            version = await self.get_version(version_id)
 
-            for file_dict in self.version_dict[str(version_id)]['files']:
-                if file_dict['downloadUrl'] == self.version_dict[str(version_id)]['downloadUrl']:
+            for file_dict in version['files']:
+                if file_dict['downloadUrl'] == version['downloadUrl']:
                     file_name_default = file_dict['name']
                     hash_sha256 = file_dict['hashes']['SHA256']
 
-            if self.version_dict[str(version_id)]['model']['type'] == 'Checkpoint':
+            if version['model']['type'] == 'Checkpoint':
                 check_path = checkpoints_path
-            elif self.version_dict[str(version_id)]['model']['type'] == 'LORA':
+            elif version['model']['type'] == 'LORA':
                 check_path = loras_path
-            already_downloaded_list = glob.glob(os.path.join(check_path, '**', '*'), recursive=True)
-            for already_file in already_downloaded_list:
-                if os.path.isfile(already_file):
-                    with open(already_file, 'rb') as f:
-                        if str(hashlib.sha256(f.read()).hexdigest()).lower() == hash_sha256.lower():
-                            return already_file
-
-            headers = {}
-            if 'civitai_api_key' in settings_dict:
-                headers = {"Authorization": f"Bearer {settings_dict['civitai_api_key']}"}
-            else:
-                civitai_api_key = os.environ.get('CIVITAI_API_KEY')
-                if civitai_api_key is not None:
-                    headers = {"Authorization": f"Bearer {civitai_api_key}"}
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.get(self.version_dict[str(version_id)]['downloadUrl']) as response:
-                    download_data = await response.read()
-            
-            if self.version_dict[str(version_id)]['model']['type'] == 'Checkpoint':
+            init_hash_cache()
+            if check_path is not None:
+                already_downloaded_list = [model_file.path for model_file in get_model_registry(check_path).get_files()]
+                already_file = await asyncio.get_running_loop().run_in_executor(None, hash_cache.find, already_downloaded_list, hash_sha256)
+                if already_file is not None:
+                    return already_file
+
+            if version['model']['type'] == 'Checkpoint':
                 if 'checkpoints_path' in settings_dict:
                     download_write_path = settings_dict['checkpoints_path']
                 elif checkpoints_path is not None:
                     download_write_path = checkpoints_path
                 else:
                     download_write_path = os.path.join(settings_dict['save_path'], 'models', 'StableDiffusion')
-            elif self.version_dict[str(version_id)]['model']['type'] == 'LORA':
+            elif version['model']['type'] == 'LORA':
                 if 'lora_path' in settings_dict:
                     download_write_path = settings_dict['lora_path']
                 elif loras_path is not None:
@@ -175,7 +242,12 @@ class CivitaiAPI():
                 else:
                     download_write_path = os.path.join(settings_dict['save_path'], 'models', 'Lora')
             os.makedirs(download_write_path, exist_ok=True)
-            
+
+            # The partial file is named after the Civitai file name, so an
+            # interrupted install of the same version resumes where it stopped.
+            part_path = os.path.join(download_write_path, file_name_default + '.part')
+            await self.download_manager.download(task, version['downloadUrl'], part_path, hash_sha256, civitai_headers())
+
             file_name = file_name_default
             file_full_path = os.path.join(download_write_path, file_name)
             if os.path.isfile(file_full_path):
@@ -186,53 +258,68 @@ class CivitaiAPI():
                     file_full_path = os.path.join(download_write_path, file_name)
                     file_index += 1
 
-            with open(file_full_path, 'wb') as f:
-                f.write(download_data)
+            os.replace(part_path, file_full_path)
+            hash_cache.put(file_full_path, hash_sha256)
 
             return file_full_path
 
-        async def download_task():
-            with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-                settings_dict = json.load(f)
-
-            self.download_ids.append(download_id)
+        async def download_task(task: DownloadTask):
+            settings_dict = settings_store.get()
 
-            if version_id is None or 'model' in self.version_dict[str(version_id)] and 'type' in self.version_dict[str(version_id)]['model'] and self.version_dict[str(version_id)]['model']['type'] == 'LORA' and 'not_installed' in settings_dict['checkpoints'][base_model_name]:
+            if version_id is None or 'model' in version and 'type' in version['model'] and version['model']['type'] == 'LORA' and 'not_installed' in settings_dict['checkpoints'][base_model_name]:
                 version_id_base = settings_dict['checkpoints'][base_model_name]['version_id']
-                if not str(version_id_base) in self.version_dict:
-                    self.version_dict[str(version_id_base)] = await civitai_fetch(f'https://civitai.com/api/v1/model-versions/{version_id_base}')
-                file_full_path = await download_task_main(version_id_base)
-                with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-                    settings_dict = json.load(f)
+                file_full_path = await download_task_main(task, version_id_base)
+                settings_dict = settings_store.load_for_update()
                 processed_file_name = os.path.splitext(os.path.basename(file_full_path))[0]
                 if processed_file_name != settings_dict['checkpoints'][base_model_name]['name']:
                     settings_dict['checkpoints'][base_model_name]['name'] = processed_file_name
                 if 'not_installed' in settings_dict['checkpoints'][base_model_name]:
                     del settings_dict['checkpoints'][base_model_name]['not_installed']
-                with open(get_path_settings_file('settings.json', new_file=True), 'w', encoding="utf-8") as f:
-                    json.dump(settings_dict, f, indent=2)
+                settings_store.save(settings_dict)
 
             if version_id is not None:
-                file_full_path = await download_task_main(version_id)
-                self.__rewrite_settings(version_id, base_model_name, os.path.basename(file_full_path), caption, weight)
+                file_full_path = await download_task_main(task, version_id)
+                self.__rewrite_settings(version, base_model_name, os.path.basename(file_full_path), caption, weight)
 
-            self.download_ids.remove(download_id)
-            self.finished_ids.append(download_id)
-
-        asyncio.create_task(download_task())
+        self.__init_download_manager()
+        self.download_manager.start(download_id, download_task)
 
         return download_id
 
-    def download_status(self, download_id: str):
-        if download_id in self.download_ids:
-            return 'Downloading.'
-        elif download_id in self.finished_ids:
-            return 'Finished.'
-        else:
-            return 'Nothing.'
+    def download_status(self, download_id: str) -> dict | None:
+        if self.download_manager is None:
+            return None
+        return self.download_manager.status(download_id)
+
+    def cancel_download(self, download_id: str) -> bool:
+        if self.download_manager is None:
+            return False
+        return self.download_manager.cancel(download_id)
+
+    async def __fetch_search_page(self, query: str, page: int) -> dict:
+        search_results = await civitai_fetch(f'{CIVITAI_API_URL}/models?limit=10&page={(page + 1)}&query={urllib.parse.quote(query)}&types=Checkpoint&types=LORA', get_cache_ttl('search'))
+        for result in search_results['items']:
+            # Search items have the same shape as /models/{id}, so the model
+            # lookups that usually follow a search are served from the cache.
+            civitai_cache.put(f'{CIVITAI_API_URL}/models/{result['id']}', result)
+        return search_results
+
+    async def __prefetch(self, query: str, page: int, search_results: dict, version_count: int):
+        # Warms the cache for the calls an agent usually makes next: the
+        # latest version of the top results, then the next page.
+        try:
+            fetches = []
+            for result in search_results['items'][:version_count]:
+                if len(result['modelVersions']) > 0:
+                    fetches.append(self.get_version(result['modelVersions'][0]['id']))
+            await asyncio.gather(*fetches, return_exceptions=True)
+            if 'metadata' in search_results and 'nextPage' in search_results['metadata']:
+                await self.__fetch_search_page(query, page + 1)
+        except Exception:
+            pass
 
     async def search(self, query: str, page: int = 0):
-        search_results = await civitai_fetch(f'https://civitai.com/api/v1/models?limit=10&page={(page + 1)}&query={urllib.parse.quote(query)}&types=Checkpoint&types=LORA')
+        search_results = await self.__fetch_search_page(query, page)
         ret = []
         for result in search_results['items']:
             ret_item = {
@@ -242,7 +329,11 @@ class CivitaiAPI():
                 'type': result['type'],
             }
             ret.append(ret_item)
-            self.model_dict[str(result['id'])] = result
-            for version in self.model_dict[str(result['id'])]['modelVersions']:
-                self.version_dict[str(version['id'])] = version
+
+        settings_dict = settings_store.get()
+        cache_settings = settings_dict['civitai_cache'] if 'civitai_cache' in settings_dict else {}
+        if cache_settings.get('prefetch', True):
+            prefetch_task = asyncio.create_task(self.__prefetch(query, page, search_results, cache_settings.get('prefetch_versions', 3)))
+            self.prefetch_tasks.add(prefetch_task)
+            prefetch_task.add_done_callback(self.prefetch_tasks.discard)
         return ret
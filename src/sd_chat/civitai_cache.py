@@ -0,0 +1,53 @@
+import json
+import time
+import sqlite3
+import threading
+
+class CachedResponse:
+    def __init__(self, body, etag: str | None, last_modified: str | None, fetched_at: float):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+class CivitaiCache:
+    def __init__(self, db_path: str, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+    def get(self, url: str) -> CachedResponse | None:
+        with self.lock:
+            row = self.conn.execute('SELECT body, etag, last_modified, fetched_at FROM responses WHERE url = ?', (url, )).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        return CachedResponse(json.loads(row[0]), row[1], row[2], row[3])
+
+    def put(self, url: str, body, etag: str | None = None, last_modified: str | None = None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses (url, body, etag, last_modified, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)', (url, json.dumps(body, ensure_ascii=False), etag, last_modified, now, now))
+            self.__evict()
+
+    def touch(self, url: str):
+        # A 304 revalidation: the stored body is good for another TTL.
+        now = time.time()
+        with self.lock:
+            self.conn.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+
+    def __evict(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('DELETE FROM responses WHERE url IN (SELECT url FROM responses ORDER BY accessed_at LIMIT ?)', (count - self.max_entries, ))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,244 @@
+import os
+import time
+import hashlib
+import asyncio
+import traceback
+import urllib.parse
+import aiohttp
+from collections import OrderedDict
+
+from .hash_cache import HASH_CHUNK_SIZE, hash_file
+from .http_client import get_http_session
+
+DOWNLOAD_QUEUED = 'queued'
+DOWNLOAD_RUNNING = 'downloading'
+DOWNLOAD_FINISHED = 'finished'
+DOWNLOAD_FAILED = 'failed'
+DOWNLOAD_CANCELLED = 'cancelled'
+
+DOWNLOAD_FINISHED_STATES = (DOWNLOAD_FINISHED, DOWNLOAD_FAILED, DOWNLOAD_CANCELLED)
+
+class HashMismatchError(Exception):
+    pass
+
+class DownloadTask:
+    def __init__(self, download_id: str):
+        self.download_id = download_id
+        self.state = DOWNLOAD_QUEUED
+        self.file_name = None
+        self.bytes = 0
+        self.total = None
+        self.session_bytes = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.task = None
+
+    def start_file(self, file_name: str):
+        self.state = DOWNLOAD_RUNNING
+        self.file_name = file_name
+        self.bytes = 0
+        self.total = None
+        self.session_bytes = 0
+        self.started_at = time.monotonic()
+
+    def add_bytes(self, size: int, resumed: bool = False):
+        # Resumed bytes count towards progress but not towards throughput.
+        self.bytes += size
+        if not resumed:
+            self.session_bytes += size
+
+    def to_dict(self) -> dict:
+        ret = {
+            'state': self.state,
+            'file_name': self.file_name,
+            'bytes': self.bytes,
+            'total': self.total,
+        }
+        if self.total is not None and self.total > 0:
+            ret['percent'] = round(100.0 * self.bytes / self.total, 1)
+        if self.state == DOWNLOAD_RUNNING and self.started_at is not None:
+            elapsed = time.monotonic() - self.started_at
+            if elapsed > 0:
+                bytes_per_second = self.session_bytes / elapsed
+                ret['bytes_per_second'] = int(bytes_per_second)
+                if self.total is not None and bytes_per_second > 0:
+                    ret['eta_seconds'] = int((self.total - self.bytes) / bytes_per_second)
+        if self.error is not None:
+            ret['error'] = self.error
+        return ret
+
+async def fetch_to_file(session: aiohttp.ClientSession, url: str, path: str, headers: dict, chunk_size: int, task: DownloadTask | None, hasher=None, start: int = 0, end: int | None = None):
+    # Appends bytes start..end (inclusive) of url to path, resuming from what
+    # path already holds. Returns False if the server ignored the Range
+    # header, in which case nothing was written.
+    offset = os.path.getsize(path) if os.path.isfile(path) else 0
+    if end is not None and start + offset > end:
+        return True
+    request_headers = dict(headers)
+    if start + offset > 0 or end is not None:
+        request_headers['Range'] = f'bytes={start + offset}-{end if end is not None else ""}'
+    async with session.get(url, headers=request_headers) as response:
+        if response.status == 416 and offset > 0 and end is None:
+            # The partial file already holds the whole body.
+            return True
+        response.raise_for_status()
+        if response.status != 206 and 'Range' in request_headers:
+            return False
+        if task is not None and task.total is None and response.content_length is not None and end is None:
+            task.total = start + offset + response.content_length
+        with open(path, 'ab') as f:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                if task is not None:
+                    task.add_bytes(len(chunk))
+    return True
+
+async def probe_download(session: aiohttp.ClientSession, url: str, headers: dict):
+    # Follows redirects once and asks for a single byte, to learn the final
+    # URL, the total size and whether ranges are served.
+    async with session.get(url, headers=dict(headers, Range='bytes=0-0')) as response:
+        response.raise_for_status()
+        content_range = response.headers.get('Content-Range', '')
+        if response.status == 206 and '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+            return str(response.url), int(content_range.rsplit('/', 1)[1]), True
+        return str(response.url), response.content_length, False
+
+def join_segments(part_path: str, segment_paths: list, chunk_size: int = HASH_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(part_path, 'wb') as f:
+        for segment_path in segment_paths:
+            with open(segment_path, 'rb') as segment_f:
+                while True:
+                    chunk = segment_f.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha256.update(chunk)
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+    return sha256
+
+async def download_file(url: str, part_path: str, sha256: str | None = None, headers: dict | None = None, chunk_size: int = HASH_CHUNK_SIZE, task: DownloadTask | None = None, segments: int = 1, min_segment_size: int = 0) -> str:
+    # Streams url into part_path, hashing while writing. An existing
+    # part_path is resumed with a Range request; the caller renames the file
+    # into place once this returns.
+    headers = dict(headers) if headers is not None else {}
+    session = get_http_session()
+    if segments > 1 and not os.path.isfile(part_path):
+        final_url, total, accepts_ranges = await probe_download(session, url, headers)
+        if accepts_ranges and total is not None and total >= segments * min_segment_size:
+            # Authorization only goes along while the URL stays on the same
+            # host; presigned storage URLs must not get it.
+            segment_headers = headers if urllib.parse.urlsplit(final_url).netloc == urllib.parse.urlsplit(url).netloc else {}
+            hasher = await download_segments(session, final_url, part_path, total, segments, chunk_size, task, segment_headers)
+            return verify_download(url, part_path, hasher, sha256)
+
+    if os.path.isfile(part_path) and os.path.getsize(part_path) > 0:
+        hasher = await asyncio.get_running_loop().run_in_executor(None, hash_file, part_path)
+        if task is not None:
+            task.add_bytes(os.path.getsize(part_path), resumed=True)
+    else:
+        hasher = hashlib.sha256()
+    if not await fetch_to_file(session, url, part_path, headers, chunk_size, task, hasher):
+        # The server ignored the Range header; start over.
+        os.remove(part_path)
+        hasher = hashlib.sha256()
+        if task is not None:
+            task.bytes = 0
+        await fetch_to_file(session, url, part_path, headers, chunk_size, task, hasher)
+    return verify_download(url, part_path, hasher, sha256)
+
+async def download_segments(session: aiohttp.ClientSession, url: str, part_path: str, total: int, segments: int, chunk_size: int, task: DownloadTask | None, headers: dict | None = None):
+    # Each segment goes to its own file so it can be resumed on its own;
+    # they are joined and hashed once all have finished.
+    if task is not None:
+        task.total = total
+    segment_size = (total + segments - 1) // segments
+    segment_paths = []
+    fetches = []
+    for index in range(segments):
+        start = index * segment_size
+        end = min(total, start + segment_size) - 1
+        segment_path = f'{part_path}.{index}'
+        if os.path.isfile(segment_path) and task is not None:
+            task.add_bytes(os.path.getsize(segment_path), resumed=True)
+        segment_paths.append(segment_path)
+        fetches.append(fetch_to_file(session, url, segment_path, headers if headers is not None else {}, chunk_size, task, None, start, end))
+    results = await asyncio.gather(*fetches)
+    if not all(results):
+        raise aiohttp.ClientPayloadError(f'Range requests are not served for {url}')
+    return await asyncio.get_running_loop().run_in_executor(None, join_segments, part_path, segment_paths, chunk_size)
+
+def verify_download(url: str, part_path: str, hasher, sha256: str | None) -> str:
+    digest = hasher.hexdigest()
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part_path)
+        raise HashMismatchError(f'SHA256 mismatch for {url}: expected {sha256.lower()}, got {digest}')
+    return digest
+
+class DownloadManager:
+    def __init__(self, max_concurrent: int = 2, max_retries: int = 3, retry_backoff: float = 2.0, segments: int = 1, min_segment_mb: int = 64, max_finished: int = 256):
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.segments = segments
+        self.min_segment_size = min_segment_mb * 1024 * 1024
+        self.max_finished = max_finished
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.tasks = OrderedDict()
+
+    def __evict(self):
+        finished_ids = [download_id for download_id, task in self.tasks.items() if task.state in DOWNLOAD_FINISHED_STATES]
+        for download_id in finished_ids[:max(0, len(finished_ids) - self.max_finished)]:
+            del self.tasks[download_id]
+
+    def start(self, download_id: str, task_func) -> DownloadTask:
+        # task_func(task) is a coroutine function that calls download() for
+        # each file it needs.
+        task = DownloadTask(download_id)
+        self.tasks[download_id] = task
+        self.__evict()
+        task.task = asyncio.create_task(self.__run(task, task_func))
+        return task
+
+    async def __run(self, task: DownloadTask, task_func):
+        try:
+            await task_func(task)
+            task.state = DOWNLOAD_FINISHED
+        except asyncio.CancelledError:
+            task.state = DOWNLOAD_CANCELLED
+        except Exception as e:
+            traceback.print_exc()
+            task.state = DOWNLOAD_FAILED
+            task.error = f'{type(e).__name__}: {e}'
+        finally:
+            task.finished_at = time.monotonic()
+
+    async def download(self, task: DownloadTask, url: str, part_path: str, sha256: str | None = None, headers: dict | None = None) -> str:
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                task.start_file(os.path.basename(part_path).removesuffix('.part'))
+                try:
+                    return await download_file(url, part_path, sha256, headers, task=task, segments=self.segments, min_segment_size=self.min_segment_size)
+                except (aiohttp.ClientError, asyncio.TimeoutError, HashMismatchError) as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    task.error = f'{type(e).__name__}: {e} (retrying)'
+                    await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+                    task.error = None
+
+    def cancel(self, download_id: str) -> bool:
+        # The .part file is kept, so installing the same model again resumes.
+        task = self.tasks.get(download_id)
+        if task is None or task.state in DOWNLOAD_FINISHED_STATES:
+            return False
+        task.task.cancel()
+        return True
+
+    def status(self, download_id: str) -> dict | None:
+        task = self.tasks.get(download_id)
+        if task is None:
+            return None
+        return task.to_dict()
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path: str, chunk_size: int = HASH_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256
+
+def sha256_file(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    # Module level so it can be pickled into a process pool.
+    return hash_file(path, chunk_size).hexdigest()
+
+class HashCache:
+    def __init__(self, db_path: str, max_workers: int | None = None):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS hashes_sha256 ON hashes (sha256)')
+
+    def __lookup(self, path: str, stat: os.stat_result) -> str | None:
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, sha256 FROM hashes WHERE path = ?', (path, )).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return row[2]
+
+    def put(self, path: str, sha256: str, stat: os.stat_result | None = None):
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, sha256.lower()))
+
+    def get(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        sha256 = self.__lookup(path, stat)
+        if sha256 is None:
+            sha256 = sha256_file(path)
+            self.put(path, sha256, stat)
+        return sha256
+
+    def get_many(self, paths: list) -> dict:
+        # Files whose (size, mtime) still match are answered from the cache;
+        # the rest are hashed in parallel, one file per worker process.
+        ret = {}
+        missing = []
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            sha256 = self.__lookup(path, stat)
+            if sha256 is None:
+                missing.append((path, stat))
+            else:
+                ret[path] = sha256
+        if len(missing) == 1:
+            path, stat = missing[0]
+            ret[path] = sha256_file(path)
+            self.put(path, ret[path], stat)
+        elif len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [(path, stat, executor.submit(sha256_file, path)) for path, stat in missing]
+                for path, stat, future in futures:
+                    try:
+                        ret[path] = future.result()
+                    except OSError:
+                        continue
+                    self.put(path, ret[path], stat)
+        return ret
+
+    def find(self, paths: list, sha256: str) -> str | None:
+        sha256 = sha256.lower()
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM hashes WHERE sha256 = ?', (sha256, )).fetchall()
+        # A cached match only counts if the file is still unchanged on disk.
+        candidates = set(os.path.abspath(path) for path in paths)
+        for row in rows:
+            if not row[0] in candidates:
+                continue
+            try:
+                stat = os.stat(row[0])
+            except OSError:
+                continue
+            if self.__lookup(row[0], stat) == sha256:
+                return row[0]
+        for path, file_sha256 in self.get_many(paths).items():
+            if file_sha256 == sha256:
+                return path
+        return None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
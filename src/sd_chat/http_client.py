@@ -0,0 +1,78 @@
+import sys
+import asyncio
+import threading
+import aiohttp
+
+class HttpClient:
+    def __init__(self, limit: int = 100, limit_per_host: int = 8, dns_cache_ttl: int = 300, keepalive_timeout: float = 30.0, connect_timeout: float = 30.0, read_timeout: float = 300.0, request_timeout: float = 60.0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.request_timeout = request_timeout
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def configure(self, http_settings: dict):
+        for key in ('limit', 'limit_per_host', 'dns_cache_ttl', 'keepalive_timeout', 'connect_timeout', 'read_timeout', 'request_timeout'):
+            if key in http_settings:
+                setattr(self, key, http_settings[key])
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # aiohttp sessions are bound to the loop they were created on, and the
+        # MCP server and the HTTP server run separate loops, so each loop
+        # gets its own pooled session.
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.__drop_closed_loops()
+            session = self.sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_cache_ttl, keepalive_timeout=self.keepalive_timeout)
+                # No total timeout on the session: model downloads can take
+                # hours. Short API calls pass get_request_timeout() instead.
+                timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.read_timeout)
+                session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+                self.sessions[loop] = session
+            return session
+
+    def __drop_closed_loops(self):
+        # A session must be closed on its own loop (close()) before that loop
+        # shuts down; once the loop is closed its transports can no longer be
+        # closed cleanly, so the session is only dropped and reported.
+        for loop in [loop for loop in self.sessions if loop.is_closed()]:
+            session = self.sessions.pop(loop)
+            if not session.closed:
+                print('Warning: HTTP session of a closed event loop was not closed.', file=sys.stderr)
+
+    def get_request_timeout(self) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=self.request_timeout, connect=self.connect_timeout, sock_read=self.read_timeout)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            session = self.sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    def close_all(self, timeout: float = 5.0):
+        # Called from a thread that is not running any of the loops, e.g. on
+        # shutdown after the servers returned.
+        with self.lock:
+            self.__drop_closed_loops()
+            sessions = list(self.sessions.items())
+            self.sessions.clear()
+        for loop, session in sessions:
+            try:
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout)
+                elif not loop.is_closed():
+                    loop.run_until_complete(session.close())
+            except Exception:
+                pass
+
+http_client = HttpClient()
+
+def get_http_session() -> aiohttp.ClientSession:
+    return http_client.get_session()
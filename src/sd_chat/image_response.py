@@ -0,0 +1,113 @@
+import os
+import re
+import email.utils
+import mimetypes
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from PIL import Image
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+VARIANT_FORMATS = {
+    'png': ('PNG', 'png'),
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+    'jpg': ('JPEG', 'jpg'),
+}
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def make_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+def is_not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            modified_since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= modified_since.timestamp()
+    return False
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+def parse_range(range_header: str, file_size: int):
+    # Returns None for headers we do not serve (multiple ranges, other
+    # units, invalid syntax); the caller then sends the whole file, as
+    # RFC 9110 allows. Only a valid but unsatisfiable range raises.
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        return None
+    start, end = match.group(1), match.group(2)
+    if start == '' and end == '':
+        return None
+    if start == '':
+        length = int(end)
+        if length <= 0 or file_size <= 0:
+            raise RangeNotSatisfiableError()
+        return max(file_size - length, 0), file_size - 1
+    start = int(start)
+    if end != '' and int(end) < start:
+        return None
+    if start >= file_size:
+        raise RangeNotSatisfiableError()
+    end = int(end) if end != '' else file_size - 1
+    return start, min(end, file_size - 1)
+
+def build_image_response(request: Request, path: str) -> Response:
+    stat = os.stat(path)
+    etag = make_etag(stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+        'Cache-Control': CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+    if is_not_modified(request, etag, stat):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header is not None and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except RangeNotSatisfiableError:
+            headers['Content-Range'] = f'bytes */{stat.st_size}'
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            with open(path, 'rb') as f:
+                f.seek(start)
+                content = f.read(end - start + 1)
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            return Response(content=content, status_code=206, headers=headers, media_type=mimetypes.guess_type(path)[0])
+
+    return FileResponse(path, headers=headers)
+
+def get_variant_path(derivatives_dir_path: str, image_id: str, source_path: str, width: int | None, image_format: str | None) -> str:
+    if image_format is None:
+        image_format = os.path.splitext(source_path)[1][1:].lower()
+    pil_format, ext = VARIANT_FORMATS[image_format]
+    width_name = str(width) if width is not None else 'full'
+    variant_path = os.path.join(derivatives_dir_path, f'{image_id}_{width_name}.{ext}')
+    if os.path.isfile(variant_path):
+        return variant_path
+
+    os.makedirs(derivatives_dir_path, exist_ok=True)
+    with Image.open(source_path) as image:
+        if width is not None and width < image.width:
+            image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        # Write under a temporary name so concurrent requests never serve
+        # a half written derivative.
+        temp_path = f'{variant_path}.{os.getpid()}.{id(image)}.tmp'
+        image.save(temp_path, format=pil_format)
+    os.replace(temp_path, variant_path)
+    return variant_path
@@ -0,0 +1,38 @@
+import os
+import json
+import sqlite3
+import threading
+
+class ImageStore:
+    def __init__(self, db_path: str, json_path: str | None = None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images (image_id TEXT PRIMARY KEY, path TEXT NOT NULL)')
+        if json_path is not None and os.path.isfile(json_path):
+            self.__migrate(json_path)
+
+    def __migrate(self, json_path: str):
+        with open(json_path, 'r', encoding="utf-8") as f:
+            images_dict = json.load(f)
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO images (image_id, path) VALUES (?, ?)', images_dict.items())
+            self.conn.execute('COMMIT')
+        os.replace(json_path, json_path + '.migrated')
+
+    def get(self, image_id: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute('SELECT path FROM images WHERE image_id = ?', (image_id, )).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, image_id: str, path: str):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO images (image_id, path) VALUES (?, ?)', (image_id, path))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,46 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, Future
+from PIL import Image, ExifTags, PngImagePlugin
+
+from .output_allocator import OutputAllocator
+
+FORMAT_EXTENSIONS = {
+    'png': 'png',
+    'webp': 'webp',
+    'jpeg': 'jpg',
+}
+
+class ImageWriter:
+    def __init__(self, output_allocator: OutputAllocator, image_format: str = 'png', png_compress_level: int = 6, quality: int = 90, max_workers: int = 2):
+        image_format = image_format.lower()
+        if image_format == 'jpg':
+            image_format = 'jpeg'
+        if not image_format in FORMAT_EXTENSIONS:
+            raise ValueError(f'Unsupported image format: {image_format}')
+        self.output_allocator = output_allocator
+        self.image_format = image_format
+        self.png_compress_level = png_compress_level
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sd_chat_image_writer')
+
+    def __save(self, image: Image.Image, seed, infotext: str | None) -> str:
+        save_path = self.output_allocator.allocate(seed, FORMAT_EXTENSIONS[self.image_format])
+        if self.image_format == 'png':
+            metadata = None
+            if infotext is not None:
+                metadata = PngImagePlugin.PngInfo()
+                metadata.add_text('parameters', infotext)
+            image.save(save_path, format='PNG', pnginfo=metadata, compress_level=self.png_compress_level)
+        else:
+            # WebP and JPEG have no text chunks; store the parameters the way
+            # the webui does, as an EXIF UserComment.
+            exif = Image.Exif()
+            if infotext is not None:
+                exif[ExifTags.IFD.Exif] = {ExifTags.Base.UserComment: b'UNICODE\0' + infotext.encode('utf-16-be')}
+            if self.image_format == 'jpeg' and image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.save(save_path, format=self.image_format.upper(), quality=self.quality, exif=exif)
+        return os.path.abspath(save_path)
+
+    def submit(self, image: Image.Image, seed, infotext: str | None = None) -> Future:
+        return self.executor.submit(self.__save, image, seed, infotext)
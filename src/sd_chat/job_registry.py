@@ -0,0 +1,95 @@
+import time
+import threading
+from collections import OrderedDict
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_STATES = (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+
+class JobRegistry:
+    def __init__(self, ttl: float = 3600.0, max_finished: int = 1024):
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished_ids = OrderedDict()
+        self.counts = {state: 0 for state in JOB_STATES}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def __notify(self, job):
+        for listener in self.listeners:
+            listener(job)
+
+    def __set_state(self, job, state: str):
+        self.counts[job.state] -= 1
+        self.counts[state] += 1
+        job.state = state
+
+    def __evict(self):
+        # finished_ids is ordered by finish time, so only its head can expire.
+        now = time.monotonic()
+        while len(self.finished_ids) > 0:
+            image_id, finished_at = next(iter(self.finished_ids.items()))
+            if len(self.finished_ids) <= self.max_finished and now - finished_at < self.ttl:
+                break
+            del self.finished_ids[image_id]
+            job = self.jobs.pop(image_id)
+            self.counts[job.state] -= 1
+
+    def add(self, job):
+        with self.lock:
+            job.state = JOB_QUEUED
+            job.created_at = time.monotonic()
+            self.jobs[job.image_id] = job
+            self.counts[JOB_QUEUED] += 1
+            self.__evict()
+        self.__notify(job)
+
+    def get(self, image_id: str):
+        with self.lock:
+            return self.jobs.get(image_id)
+
+    def __contains__(self, image_id: str):
+        return image_id in self.jobs
+
+    def count(self, state: str | None = None) -> int:
+        if state is None:
+            return len(self.jobs)
+        return self.counts[state]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counts)
+
+    def mark_running(self, job):
+        with self.lock:
+            self.__set_state(job, JOB_RUNNING)
+            job.started_at = time.monotonic()
+        self.__notify(job)
+
+    def __finish(self, job, state: str):
+        with self.lock:
+            if job.image_id in self.finished_ids:
+                return False
+            self.__set_state(job, state)
+            job.finished_at = time.monotonic()
+            if job.image_id in self.jobs:
+                self.finished_ids[job.image_id] = job.finished_at
+            self.__evict()
+            return True
+
+    def mark_done(self, job, result):
+        if self.__finish(job, JOB_DONE):
+            job.future.set_result(result)
+            self.__notify(job)
+
+    def mark_failed(self, job, exception: BaseException):
+        if self.__finish(job, JOB_FAILED):
+            job.future.set_exception(exception)
+            self.__notify(job)
@@ -0,0 +1,146 @@
+import threading
+import time
+import itertools
+import traceback
+import sys
+import concurrent.futures
+
+from .settings import CheckPointSettings
+from .job_registry import JOB_QUEUED
+
+class QueueFullError(Exception):
+    pass
+
+def make_group_key(checkpoint_settings: CheckPointSettings, lora_settings: list):
+    lora_names = tuple(sorted(lora_setting_item.name for lora_setting_item in lora_settings)) if lora_settings is not None else ()
+    return (checkpoint_settings.name, lora_names)
+
+def make_checkpoint_group_key(checkpoint_settings: CheckPointSettings, lora_settings: list):
+    return (checkpoint_settings.name, )
+
+def make_batch_key(checkpoint_settings: CheckPointSettings, lora_settings: list):
+    loras = tuple((lora_setting_item.name, lora_setting_item.weight) for lora_setting_item in lora_settings) if lora_settings is not None else ()
+    return (
+        checkpoint_settings.name,
+        checkpoint_settings.base_model,
+        checkpoint_settings.sampler_name,
+        checkpoint_settings.steps,
+        checkpoint_settings.cfg_scale,
+        checkpoint_settings.width,
+        checkpoint_settings.height,
+        checkpoint_settings.clip_skip,
+        checkpoint_settings.prompt,
+        checkpoint_settings.negative_prompt,
+        loras,
+    )
+
+class Job:
+    def __init__(self, image_id: str, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list, priority: int = 0):
+        self.image_id = image_id
+        self.prompt = prompt
+        self.checkpoint_settings = checkpoint_settings
+        self.lora_settings = lora_settings
+        self.priority = priority
+        self.group_key = make_group_key(checkpoint_settings, lora_settings)
+        self.batch_key = make_batch_key(checkpoint_settings, lora_settings)
+        self.sequence = -1
+        self.future = concurrent.futures.Future()
+        self.state = JOB_QUEUED
+        self.created_at = None
+        self.started_at = None
+        self.finished_at = None
+
+class JobScheduler:
+    def __init__(self, process_func, max_queue_size: int = 16, max_group_streak: int = 4, max_batch_size: int = 1, max_batch_wait: float = 0.0, group_key_func=None, name: str = 'sd_chat_job_scheduler'):
+        self.process_func = process_func
+        self.group_key_func = group_key_func
+        self.max_queue_size = max_queue_size
+        self.max_group_streak = max_group_streak
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_batch_wait = max_batch_wait
+        self.name = name
+        self.condition = threading.Condition()
+        self.queue = []
+        self.sequence_counter = itertools.count()
+        self.current_group_key = None
+        self.group_streak = 0
+        self.worker_thread = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        # Called after each put(); lets a consumer without a worker thread
+        # (process_func=None) wake up and call take_nowait().
+        self.listeners.append(listener)
+
+    def put(self, job: Job):
+        with self.condition:
+            if self.max_queue_size > 0 and len(self.queue) >= self.max_queue_size:
+                raise QueueFullError(f'Job queue is full ({self.max_queue_size} jobs waiting).')
+            job.sequence = next(self.sequence_counter)
+            if self.group_key_func is not None:
+                job.group_key = self.group_key_func(job.checkpoint_settings, job.lora_settings)
+            self.queue.append(job)
+            self.condition.notify()
+            if self.worker_thread is None and self.process_func is not None:
+                self.worker_thread = threading.Thread(target=self.__worker_func, name=self.name, daemon=True)
+                self.worker_thread.start()
+        for listener in self.listeners:
+            listener()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.queue)
+
+    def __select(self) -> Job:
+        # Highest priority wins; inside that priority, stay on the loaded
+        # checkpoint/LoRA set for up to max_group_streak jobs, then fall back to FIFO.
+        top_priority = max(job.priority for job in self.queue)
+        candidates = [job for job in self.queue if job.priority == top_priority]
+        selected = candidates[0]
+        if self.current_group_key is not None and self.group_streak < self.max_group_streak:
+            for job in candidates:
+                if job.group_key == self.current_group_key:
+                    selected = job
+                    break
+        if selected.group_key == self.current_group_key:
+            self.group_streak += 1
+        else:
+            self.current_group_key = selected.group_key
+            self.group_streak = 1
+        self.queue.remove(selected)
+        return selected
+
+    def take_nowait(self) -> list | None:
+        with self.condition:
+            if len(self.queue) <= 0:
+                return None
+            return [self.__select(), ]
+
+    def take(self) -> list:
+        with self.condition:
+            while len(self.queue) <= 0:
+                self.condition.wait()
+            batch = [self.__select(), ]
+            # Pull queued jobs that can share one pipeline call, waiting up to
+            # max_batch_wait for more of them to arrive.
+            deadline = time.monotonic() + self.max_batch_wait
+            while len(batch) < self.max_batch_size:
+                for job in list(self.queue):
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    if job.batch_key == batch[0].batch_key:
+                        self.queue.remove(job)
+                        batch.append(job)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return batch
+
+    def __worker_func(self):
+        while True:
+            jobs = self.take()
+            try:
+                self.process_func(jobs)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
@@ -0,0 +1,39 @@
+import io
+import base64
+import torch
+from PIL import Image
+
+# Linear approximations of the VAE decoder, mapping the 4 latent channels
+# straight to RGB. Good enough for a progress thumbnail at 1/8 resolution.
+SD15_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+SD15_LATENT_RGB_BIAS = [0.0, 0.0, 0.0]
+
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+def latents_to_previews(latents: torch.Tensor, is_xl: bool, quality: int = 70) -> list:
+    if is_xl:
+        factors, bias = SDXL_LATENT_RGB_FACTORS, SDXL_LATENT_RGB_BIAS
+    else:
+        factors, bias = SD15_LATENT_RGB_FACTORS, SD15_LATENT_RGB_BIAS
+    factors = torch.tensor(factors, dtype=torch.float32, device=latents.device)
+    bias = torch.tensor(bias, dtype=torch.float32, device=latents.device)
+    with torch.no_grad():
+        rgb = torch.einsum('bchw,cr->bhwr', latents.float(), factors) + bias
+        rgb = ((rgb + 1.0) / 2.0).clamp(0.0, 1.0).mul(255.0).to(torch.uint8).cpu().numpy()
+    ret = []
+    for item in rgb:
+        buffer = io.BytesIO()
+        Image.fromarray(item).save(buffer, format='JPEG', quality=quality)
+        ret.append('data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return ret
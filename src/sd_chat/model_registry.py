@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin')
+
+class ModelFile:
+    def __init__(self, path: str, relative_name: str, size: int, mtime: float):
+        self.path = path
+        self.relative_name = relative_name
+        self.name = os.path.basename(relative_name)
+        self.size = size
+        self.mtime = mtime
+        self.format = os.path.splitext(path)[1][1:].lower()
+
+    def is_preferred_over(self, other) -> bool:
+        if (self.format == 'safetensors') != (other.format == 'safetensors'):
+            return self.format == 'safetensors'
+        return self.relative_name.count('/') < other.relative_name.count('/')
+
+class ModelRegistry:
+    def __init__(self, root_path: str, min_rescan_interval: float = 2.0):
+        self.root_path = root_path
+        self.min_rescan_interval = min_rescan_interval
+        self.lock = threading.Lock()
+        self.last_rescan = 0.0
+        self.dir_mtimes = {}
+        self.dir_files = {}
+        self.dir_subdirs = {}
+        self.name_lookup = {}
+        self.version = 0
+
+    def __scan_dir(self, dir_path: str):
+        files = {}
+        subdirs = []
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            return False
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in MODEL_EXTENSIONS:
+                stat = entry.stat()
+                relative_name = os.path.splitext(os.path.relpath(entry.path, self.root_path))[0].replace(os.sep, '/')
+                files[entry.path] = ModelFile(os.path.abspath(entry.path), relative_name, stat.st_size, stat.st_mtime)
+        self.dir_mtimes[dir_path] = mtime
+        self.dir_files[dir_path] = files
+        self.dir_subdirs[dir_path] = subdirs
+        for subdir_path in subdirs:
+            if not subdir_path in self.dir_mtimes:
+                self.__scan_dir(subdir_path)
+        return True
+
+    def __drop_dir(self, dir_path: str):
+        for subdir_path in self.dir_subdirs.pop(dir_path, []):
+            self.__drop_dir(subdir_path)
+        self.dir_mtimes.pop(dir_path, None)
+        self.dir_files.pop(dir_path, None)
+
+    def __rebuild_lookup(self):
+        name_lookup = {}
+        for files in self.dir_files.values():
+            for model_file in files.values():
+                for key in (model_file.name, model_file.relative_name):
+                    if not key in name_lookup or model_file.is_preferred_over(name_lookup[key]):
+                        name_lookup[key] = model_file
+        self.name_lookup = name_lookup
+        self.version += 1
+
+    def rescan(self, force: bool = False):
+        # A directory's mtime only moves when entries are added, removed or
+        # renamed in it, so unchanged directories are not listed again.
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.version > 0 and now - self.last_rescan < self.min_rescan_interval:
+                return
+            self.last_rescan = now
+            changed = self.version <= 0
+            if not self.root_path in self.dir_mtimes:
+                changed = self.__scan_dir(self.root_path) or changed
+            else:
+                for dir_path in list(self.dir_mtimes.keys()):
+                    if not dir_path in self.dir_mtimes:
+                        continue
+                    try:
+                        mtime = os.stat(dir_path).st_mtime_ns
+                    except OSError:
+                        self.__drop_dir(dir_path)
+                        changed = True
+                        continue
+                    if mtime != self.dir_mtimes[dir_path]:
+                        for subdir_path in self.dir_subdirs[dir_path]:
+                            if not os.path.isdir(subdir_path):
+                                self.__drop_dir(subdir_path)
+                        self.__scan_dir(dir_path)
+                        changed = True
+            if changed:
+                self.__rebuild_lookup()
+
+    def is_available(self) -> bool:
+        self.rescan()
+        return self.root_path in self.dir_mtimes
+
+    def resolve(self, name: str) -> ModelFile | None:
+        self.rescan()
+        return self.name_lookup.get(name.replace('\\', '/'))
+
+    def get_files(self) -> list:
+        self.rescan()
+        with self.lock:
+            return [model_file for files in self.dir_files.values() for model_file in files.values()]
+
+    def is_installed(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+model_registries = {}
+model_registries_lock = threading.Lock()
+
+def get_model_registry(root_path: str) -> ModelRegistry:
+    root_path = os.path.abspath(root_path)
+    with model_registries_lock:
+        if not root_path in model_registries:
+            model_registries[root_path] = ModelRegistry(root_path)
+        return model_registries[root_path]
@@ -0,0 +1,62 @@
+import os
+import re
+import datetime
+import threading
+
+FILE_INDEX_PATTERN = re.compile(r'^(\d+)_')
+
+class OutputAllocator:
+    def __init__(self, save_dir_path: str, sub_dir_name: str = 'txt2img', shard: str | int | None = None):
+        self.save_dir_path = save_dir_path
+        self.sub_dir_name = sub_dir_name
+        self.shard = shard
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def __recover(self, dir_path: str) -> int:
+        # Runs once per counter directory, then the counter lives in memory.
+        next_index = 0
+        if not os.path.isdir(dir_path):
+            return next_index
+        for entry in os.scandir(dir_path):
+            if entry.is_dir():
+                for sub_entry in os.scandir(entry.path):
+                    match = FILE_INDEX_PATTERN.match(sub_entry.name)
+                    if match is not None:
+                        next_index = max(next_index, int(match.group(1)) + 1)
+            else:
+                match = FILE_INDEX_PATTERN.match(entry.name)
+                if match is not None:
+                    next_index = max(next_index, int(match.group(1)) + 1)
+        return next_index
+
+    def __next(self, counter_dir_path: str) -> int:
+        with self.lock:
+            if not counter_dir_path in self.counters:
+                self.counters[counter_dir_path] = self.__recover(counter_dir_path)
+            index = self.counters[counter_dir_path]
+            self.counters[counter_dir_path] += 1
+            return index
+
+    def allocate(self, seed, ext: str = 'png') -> str:
+        now = datetime.datetime.now()
+        counter_dir_path = os.path.join(self.save_dir_path, self.sub_dir_name, now.strftime('%Y-%m-%d'))
+        if self.shard == 'hour':
+            counter_dir_path = os.path.join(counter_dir_path, now.strftime('%H'))
+
+        while True:
+            index = self.__next(counter_dir_path)
+            if isinstance(self.shard, int) and self.shard > 0:
+                dir_path = os.path.join(counter_dir_path, f'{index // self.shard:04}')
+            else:
+                dir_path = counter_dir_path
+            os.makedirs(dir_path, exist_ok=True)
+            file_path = os.path.join(dir_path, f'{index:05}_{seed}.{ext}')
+            try:
+                # Reserve the name so another process writing into the same
+                # directory cannot pick it as well.
+                fd = os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            return file_path
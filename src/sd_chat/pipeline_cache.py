@@ -0,0 +1,113 @@
+import os
+import gc
+from collections import OrderedDict
+import torch
+
+def get_pipeline_size(pipeline) -> int:
+    size = 0
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in component.parameters():
+                size += tensor.numel() * tensor.element_size()
+            for tensor in component.buffers():
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+class PipelineCacheEntry:
+    def __init__(self, key, pipeline, size: int):
+        self.key = key
+        self.pipeline = pipeline
+        self.size = size
+        self.base_scheduler = pipeline.scheduler
+        self.sampler_name = None
+        self.loaded_adapters = OrderedDict()
+        self.active_adapters = ()
+
+class PipelineCache:
+    def __init__(self, load_func, device: str = 'cuda', device_budget_mb: int | None = None, cpu_budget_mb: int = 0):
+        self.load_func = load_func
+        self.device = device
+        self.device_budget = device_budget_mb * 1024 * 1024 if device_budget_mb is not None else None
+        self.cpu_budget = cpu_budget_mb * 1024 * 1024
+        self.hot_entries = OrderedDict()
+        self.warm_entries = OrderedDict()
+        self.hits = 0
+        self.warm_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.warm_hits + self.misses
+        if total <= 0:
+            return 0.0
+        return (self.hits + self.warm_hits) / total
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'hit_rate': self.hit_rate(),
+            'warm_hits': self.warm_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hot': list(self.hot_entries.keys()),
+            'warm': list(self.warm_entries.keys()),
+            'hot_bytes': sum(entry.size for entry in self.hot_entries.values()),
+            'warm_bytes': sum(entry.size for entry in self.warm_entries.values()),
+        }
+
+    def __release(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __make_warm_room(self, size: int) -> bool:
+        if size > self.cpu_budget:
+            return False
+        used = sum(entry.size for entry in self.warm_entries.values())
+        while len(self.warm_entries) > 0 and used + size > self.cpu_budget:
+            _, evicted = self.warm_entries.popitem(last=False)
+            used -= evicted.size
+            self.evictions += 1
+            del evicted
+        return True
+
+    def __make_hot_room(self, size: int):
+        # Without a device budget only one pipeline stays on the device,
+        # which matches the old single-pipeline behaviour.
+        released = False
+        used = sum(entry.size for entry in self.hot_entries.values())
+        while len(self.hot_entries) > 0 and (self.device_budget is None or used + size > self.device_budget):
+            _, demoted = self.hot_entries.popitem(last=False)
+            used -= demoted.size
+            if self.__make_warm_room(demoted.size):
+                demoted.pipeline.to('cpu')
+                self.warm_entries[demoted.key] = demoted
+            else:
+                self.evictions += 1
+            del demoted
+            released = True
+        if released:
+            self.__release()
+
+    def get(self, key, file_name: str, *load_args) -> PipelineCacheEntry:
+        if key in self.hot_entries:
+            self.hits += 1
+            self.hot_entries.move_to_end(key)
+            return self.hot_entries[key]
+
+        if key in self.warm_entries:
+            self.warm_hits += 1
+            entry = self.warm_entries.pop(key)
+            self.__make_hot_room(entry.size)
+            entry.pipeline.to(self.device)
+            self.hot_entries[key] = entry
+            return entry
+
+        self.misses += 1
+        # Safetensors files are stored in fp16 or larger, so the file size
+        # is a safe upper bound until the real size is known.
+        self.__make_hot_room(os.path.getsize(file_name))
+        pipeline = self.load_func(file_name, *load_args).to(self.device)
+        entry = PipelineCacheEntry(key, pipeline, get_pipeline_size(pipeline))
+        self.hot_entries[key] = entry
+        return entry
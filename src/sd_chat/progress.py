@@ -0,0 +1,57 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+from .job_registry import JOB_DONE, JOB_FAILED
+
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+
+class ProgressHub:
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.latest_events = OrderedDict()
+        self.subscribers = {}
+
+    def publish(self, image_id: str, event: dict):
+        event = dict(event, image_id=image_id)
+        with self.lock:
+            self.latest_events[image_id] = event
+            self.latest_events.move_to_end(image_id)
+            while len(self.latest_events) > self.max_entries:
+                self.latest_events.popitem(last=False)
+            subscribers = list(self.subscribers.get(image_id, []))
+        # Publishers are worker threads; hand the event to each subscriber's
+        # own event loop.
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def publish_job_state(self, job):
+        event = {'state': job.state}
+        if job.state == JOB_DONE:
+            event['percent'] = 100.0
+        elif job.state == JOB_FAILED and job.future.done() and job.future.exception() is not None:
+            event['error'] = str(job.future.exception())
+        self.publish(job.image_id, event)
+
+    def get_latest(self, image_id: str) -> dict | None:
+        with self.lock:
+            return self.latest_events.get(image_id)
+
+    def subscribe(self, image_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        with self.lock:
+            if not image_id in self.subscribers:
+                self.subscribers[image_id] = []
+            self.subscribers[image_id].append((asyncio.get_running_loop(), queue))
+            if image_id in self.latest_events:
+                queue.put_nowait(self.latest_events[image_id])
+        return queue
+
+    def unsubscribe(self, image_id: str, queue: asyncio.Queue):
+        with self.lock:
+            if not image_id in self.subscribers:
+                return
+            self.subscribers[image_id] = [item for item in self.subscribers[image_id] if item[1] is not queue]
+            if len(self.subscribers[image_id]) <= 0:
+                del self.subscribers[image_id]
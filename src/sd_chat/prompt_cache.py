@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+import torch
+from diffusers import StableDiffusionXLPipeline
+
+class PromptEmbeddingCache:
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total <= 0:
+            return 0.0
+        return self.hits / total
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+            'entries': len(self.entries),
+        }
+
+    def __encode(self, pipeline, text: str, clip_skip: int | None):
+        with torch.no_grad():
+            if isinstance(pipeline, StableDiffusionXLPipeline):
+                prompt_embeds, _, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+                    prompt=text,
+                    device=pipeline.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False,
+                    clip_skip=clip_skip,
+                )
+            else:
+                prompt_embeds, _ = pipeline.encode_prompt(
+                    text,
+                    pipeline.device,
+                    1,
+                    False,
+                    clip_skip=clip_skip,
+                )
+                pooled_prompt_embeds = None
+        return prompt_embeds, pooled_prompt_embeds
+
+    def get(self, pipeline, pipeline_key, text: str, clip_skip: int | None):
+        # The pipeline key must cover the active LoRA set as well, since
+        # adapters can patch the text encoders. clip_skip is None for
+        # negative prompts, matching diffusers' own negative branch, which
+        # takes the final output (SD1.5) or hidden_states[-2] (SDXL).
+        key = (pipeline_key, clip_skip, text)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        value = self.__encode(pipeline, text, clip_skip)
+
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
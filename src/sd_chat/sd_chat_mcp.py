@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import threading
 import json
@@ -5,49 +6,113 @@ from typing import List, Dict
 import sys
 from contextlib import redirect_stdout
 import re
+import asyncio
 from fastmcp import FastMCP
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
 
 from .settings import CheckPointSettings, LoraSettings
-from .util import get_path_settings_file
+from .util import get_path_data_file
+from .settings_store import settings_store
+from .catalog import ModelCatalog
+from .model_registry import get_model_registry
 from .civitai import CivitaiAPI
+from .http_client import http_client
+from .job_scheduler import QueueFullError
+from .image_store import ImageStore
+from .image_response import build_image_response, get_variant_path, VARIANT_FORMATS
+from .job_registry import JOB_DONE
+from .progress import FINISHED_STATES
 
-with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-    settings_dict = json.load(f)
+settings_dict = settings_store.get()
 
 save_path = settings_dict['save_path']
 
 mcp = FastMCP("sd_chat MCP Server")
 
+if 'http' in settings_dict:
+    http_client.configure(settings_dict['http'])
+
+model_catalog = ModelCatalog(settings_store)
+
+def is_fuzzy_model_names():
+    settings_dict = settings_store.get()
+    return 'fuzzy_model_names' in settings_dict and settings_dict['fuzzy_model_names']
+
 sd_api = None
+sd_api_lock = threading.Lock()
 def init_sd_api():
+    # Called from both the MCP loop and the HTTP server thread; only one
+    # backend (and so one GPU worker and job registry) may ever be built.
     global sd_api
     if sd_api is not None:
         return
-    with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-        settings_dict = json.load(f)
-    if settings_dict['target_api'] == 'webui_client' or settings_dict['target_api'] == 'sdwebuiapi':
-        from .sdapi_webui_client import SDAPI_WebUIClient
-        if 'apis' in settings_dict and 'webui_client' in settings_dict['apis']:
-            sd_api = SDAPI_WebUIClient(save_dir_path=save_path, settings=settings_dict['apis']['webui_client'])
-        else:
-            sd_api = SDAPI_WebUIClient(save_dir_path=save_path)
-    elif settings_dict['target_api'] == 'diffusers' or settings_dict['target_api'] == 'Diffusers':
-        from .sdapi_diffusers import SDAPI_Diffusers
-        if 'checkpoints_path' in settings_dict:
-            checkpoints_dir_path = settings_dict['checkpoints_path']
-        else:
-            checkpoints_dir_path = None
-        if 'lora_path' in settings_dict:
-            loras_dir_path = settings_dict['lora_path']
-        else:
-            loras_dir_path = None
-        sd_api = SDAPI_Diffusers(save_dir_path=save_path, checkpoints_dir_path=checkpoints_dir_path, loras_dir_path=loras_dir_path)
+    with sd_api_lock:
+        if sd_api is not None:
+            return
+        settings_dict = settings_store.get()
+        if settings_dict['target_api'] == 'webui_client' or settings_dict['target_api'] == 'sdwebuiapi':
+            from .sdapi_webui_client import SDAPI_WebUIClient
+            if 'apis' in settings_dict and 'webui_client' in settings_dict['apis']:
+                new_sd_api = SDAPI_WebUIClient(save_dir_path=save_path, settings=settings_dict['apis']['webui_client'])
+            else:
+                new_sd_api = SDAPI_WebUIClient(save_dir_path=save_path)
+        elif settings_dict['target_api'] == 'diffusers' or settings_dict['target_api'] == 'Diffusers':
+            from .sdapi_diffusers import SDAPI_Diffusers
+            if 'checkpoints_path' in settings_dict:
+                checkpoints_dir_path = settings_dict['checkpoints_path']
+            else:
+                checkpoints_dir_path = None
+            if 'lora_path' in settings_dict:
+                loras_dir_path = settings_dict['lora_path']
+            else:
+                loras_dir_path = None
+            if 'apis' in settings_dict and 'diffusers' in settings_dict['apis']:
+                diffusers_settings = settings_dict['apis']['diffusers']
+            else:
+                diffusers_settings = None
+            new_sd_api = SDAPI_Diffusers(save_dir_path=save_path, checkpoints_dir_path=checkpoints_dir_path, loras_dir_path=loras_dir_path, settings=diffusers_settings)
+        init_image_store()
+        new_sd_api.jobs.add_listener(store_job_result)
+        sd_api = new_sd_api
+
+def store_job_result(job):
+    # Finished images are recorded as soon as they are written, so they
+    # outlive the job registry's TTL even if nobody fetched them yet.
+    if job.state == JOB_DONE:
+        image_store.put(job.image_id, job.future.result())
+
+image_store = None
+image_store_lock = threading.Lock()
+def init_image_store():
+    global image_store
+    if image_store is not None:
+        return
+    with image_store_lock:
+        if image_store is not None:
+            return
+        json_path = get_path_data_file('images.json')
+        if settings_store.path is not None and os.path.isfile(json_path) and os.path.samefile(json_path, settings_store.path):
+            json_path = None
+        image_store = ImageStore(get_path_data_file('images.db'), json_path)
+
+async def get_checkpoints_registry():
+    init_sd_api()
+    checkpoints_dir_path = await sd_api.get_checkpoints_dir_path()
+    if checkpoints_dir_path is None:
+        return None
+    checkpoints_registry = get_model_registry(checkpoints_dir_path)
+    # Remote webui servers report paths that do not exist here; fall back
+    # to the not_installed flag in that case.
+    if not checkpoints_registry.is_available():
+        return None
+    return checkpoints_registry
 
 http_port = 50080
 
+result_timeout = settings_dict['result_timeout'] if 'result_timeout' in settings_dict else 600
+
 http_app = FastAPI()
 
 civitai_api = CivitaiAPI()
@@ -72,16 +137,11 @@ Return value:
 """
     init_sd_api()
 
-    with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-        settings_dict = json.load(f)
-    if checkpoint_name in settings_dict['checkpoints']:
-        name = checkpoint_name
-    else:
-        for checkpoint_key, checkpoint_value in settings_dict['checkpoints'].items():
-            if checkpoint_value['name'] == checkpoint_name:
-                name = checkpoint_key
-    
-    return await civitai_api.install_model(await sd_api.get_checkpoints_dir_path(), None, None, settings_dict['checkpoints'][name]['caption'], checkpoint_name)
+    checkpoint_entry = model_catalog.find_checkpoint(checkpoint_name, is_fuzzy_model_names())
+    if checkpoint_entry is None:
+        return None
+
+    return await civitai_api.install_model(await sd_api.get_checkpoints_dir_path(), None, None, checkpoint_entry.settings.caption, checkpoint_entry.key)
 
 if not 'disable_civitai_tools' in settings_dict or not settings_dict['disable_civitai_tools']:
     @mcp.tool()
@@ -168,34 +228,61 @@ Return value:
 """
         init_sd_api()
 
-        with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-            settings_dict = json.load(f)
-        if checkpoint_name in settings_dict['checkpoints']:
-            name = checkpoint_name
-        else:
-            for checkpoint_key, checkpoint_value in settings_dict['checkpoints'].items():
-                if checkpoint_value['name'] == checkpoint_name:
-                    name = checkpoint_key
+        checkpoint_entry = model_catalog.find_checkpoint(checkpoint_name, is_fuzzy_model_names())
+        name = checkpoint_entry.key if checkpoint_entry is not None else None
 
         return await civitai_api.install_model(await sd_api.get_checkpoints_dir_path(), await sd_api.get_loras_dir_path(), version_id, caption, name, weight)
 
 @mcp.tool()
 async def civitai_download_status(download_id: str) -> str:
-    """Check if downloading.
+    """Check the progress of a download.
+
+Args:
+    download_id: ID on "civitai_install_model" or "install_default_checkpoint".
+Return value:
+    JSON with these keys, or 'Nothing.' for an unknown ID.
+        state: 'queued', 'downloading', 'finished', 'failed' or 'cancelled'.
+        file_name: File being downloaded.
+        bytes: Bytes downloaded so far.
+        total: Size of the file in bytes, if known.
+        percent: Progress of the file.
+        bytes_per_second: Current throughput.
+        eta_seconds: Estimated seconds until the file is finished.
+        error: Error message, if it failed.
+"""
+    status = civitai_api.download_status(download_id)
+    if status is None:
+        return 'Nothing.'
+    return json.dumps(status, ensure_ascii=False)
+
+@mcp.tool()
+async def civitai_cancel_download(download_id: str) -> str:
+    """Cancel a download. Installing the same model again resumes it.
 
 Args:
     download_id: ID on "civitai_install_model" or "install_default_checkpoint".
 Return value:
-    'Downloading.' or 'Finished.' or 'Nothing.'
+    'Cancelled.' or 'Nothing.'
 """
-    return civitai_api.download_status(download_id)
+    if civitai_api.cancel_download(download_id):
+        return 'Cancelled.'
+    return 'Nothing.'
 
 @mcp.tool()
-async def get_models_list() -> dict:
+async def get_models_list(checkpoint_name: str = '', base_model: str = '', installed_only: bool = False, query: str = '', page: int = 0, page_size: int = 0, compact: bool = False) -> str:
     """List of Checkpoints and Loras used for image generation.
-    
+If there are many models, narrow them down with the arguments instead of listing everything.
+
+Args:
+    checkpoint_name: Only list this Checkpoint. Leave blank for all.
+    base_model: Only list models of this category (e.g. 'SDXL 1.0', 'Pony'). Leave blank for all.
+    installed_only: Only list installed Checkpoints.
+    query: Keywords to look for in names, captions and trigger_words. Leave blank for all.
+    page: Index number of page of Loras to refer to (with page_size).
+    page_size: Number of Loras per Checkpoint on a page. 0 lists all of them.
+    compact: Only return names (Loras become a list of Lora names).
 Return value:
-    The following dict.
+    The following dict (JSON).
         key: Checkpoint's name.
         value: Checkpoint's summary and settings.
             name: File name.
@@ -208,29 +295,12 @@ Return value:
                     name: File name.
                     trigger_words: Prompt required for generation with Lora. Make sure to put it in the Prompt unless it's completely different from what you want to generate.
                     caption: Lora's description.
-                    base_model: Model category. Checkpoint and Lora's base_model must match.
+            loras_total: Number of matching Loras (only if page_size is set).
 """
-    with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-        settings_dict = json.load(f)
-    ret = {}
-    for checkpoint_item_name, checkpoint_setting_dict in settings_dict['checkpoints'].items():
-        ret[checkpoint_item_name] = {
-            'name': checkpoint_setting_dict['name'],
-            'caption': checkpoint_setting_dict['caption'],
-            'base_model': checkpoint_setting_dict['base_model'],
-            'installed': not 'not_installed' in checkpoint_setting_dict
-        }
-        ret[checkpoint_item_name]['loras'] = {}
-        for lora_item_name, lora_setting_dict in checkpoint_setting_dict['loras'].items():
-            ret[checkpoint_item_name]['loras'][lora_item_name] = {
-                'name': lora_setting_dict['name'],
-                'trigger_words': lora_setting_dict['trigger_words'],
-                'caption': lora_setting_dict['caption'],
-            }
-    return ret
+    return model_catalog.list_models_json(await get_checkpoints_registry(), checkpoint_name, base_model, installed_only, query, page, page_size, compact)
 
 @mcp.tool()
-async def txt2img(prompt: str, checkpoint_name: str, lora_names: List[str] = []) -> str:
+async def txt2img(prompt: str, checkpoint_name: str, lora_names: List[str] = [], priority: int = 0) -> str:
     """Generate image with Stable Diffusion.
 Prompt to specify is comma separated keywords.
 If it is not in English, please translate it into English (lang:en).
@@ -244,6 +314,7 @@ Args:
     prompt: The prompt to generate the image. Don't use escape characters and multibyte characters.
     checkpoint_name: Checkpoint name to use.
     lora_names: List of Lora names to use. Leave blank if not used.
+    priority: Images with a higher priority are generated first. Leave 0 unless an image is urgent.
 Return value:
     Generated image's markdown tag or error message.
 """
@@ -252,46 +323,106 @@ Return value:
     elif type(lora_names) is not list:
         lora_names = []
     init_sd_api()
-    with open(get_path_settings_file('settings.json'), 'r', encoding="utf-8") as f:
-        settings_dict = json.load(f)
-    if checkpoint_name in settings_dict['checkpoints']:
-        checkpoint_settings = CheckPointSettings(**settings_dict['checkpoints'][checkpoint_name])
+    fuzzy = is_fuzzy_model_names()
+    checkpoint_entry = model_catalog.find_checkpoint(checkpoint_name, fuzzy)
+    if checkpoint_entry is None:
+        checkpoint_error = settings_store.get_checkpoint_error(checkpoint_name)
+        if checkpoint_error is not None:
+            return f'Error: Settings of checkpoint {checkpoint_name} are invalid: {checkpoint_error}'
+        return f'Error: Checkpoint {checkpoint_name} is not found. Please check "get_models_list".'
+    checkpoint_settings = checkpoint_entry.settings
+    checkpoints_registry = await get_checkpoints_registry()
+    if checkpoints_registry is not None:
+        installed = checkpoints_registry.is_installed(checkpoint_settings.name)
     else:
-        for checkpoint_key, checkpoint_value in settings_dict['checkpoints'].items():
-            if checkpoint_value['name'] == checkpoint_name:
-                checkpoint_settings = CheckPointSettings(**checkpoint_value)
-    if checkpoint_settings.not_installed:
+        installed = not checkpoint_settings.not_installed
+    if not installed:
         return f'Error: Checkpoint {checkpoint_name} is not installed. Please install it.'
-    lora_settings = []
-    for lora_name in lora_names:
-        for lora_item_name, lora_setting_dict in checkpoint_settings.loras.items():
-            if lora_item_name == lora_name or lora_setting_dict.name == lora_name:
-                lora_settings.append(lora_setting_dict)
-    image_id = sd_api.start_txt2img(prompt, checkpoint_settings, lora_settings)
+    lora_settings = model_catalog.find_loras(checkpoint_entry, lora_names, fuzzy)
+    try:
+        image_id = sd_api.start_txt2img(prompt, checkpoint_settings, lora_settings, priority)
+    except QueueFullError:
+        return 'Error: Image generation queue is full. Please wait for the current images to finish and try again.'
     url = f'http://localhost:{http_port}/get_result/{image_id}'
     return f'![Generation Result]({url})'
 
+async def image_result_response(request: Request, image_id: str, result_path: str, width: int | None, image_format: str | None):
+    if width is not None or image_format is not None:
+        result_path = await asyncio.to_thread(get_variant_path, os.path.join(save_path, 'derivatives'), image_id, result_path, width, image_format)
+    return build_image_response(request, result_path)
+
 @http_app.get("/get_result/{image_id}")
-async def get_result(image_id: str):
+async def get_result(request: Request, image_id: str, w: int | None = Query(default=None, ge=16, le=4096), image_format: str | None = Query(default=None, alias='format')):
+    if image_format is not None:
+        image_format = image_format.lower()
+        if not image_format in VARIANT_FORMATS:
+            raise HTTPException(status_code=400, detail="Unsupported format")
     init_sd_api()
-    json_file_name = get_path_settings_file('images.json')
-    if json_file_name is not None:
-        with open(json_file_name, 'r', encoding="utf-8") as f:
-            images_dict = json.load(f)
-        if image_id in images_dict:
-            return FileResponse(images_dict[image_id])
-    else:
-        images_dict = {}
-    result_path = await sd_api.get_result(image_id)
+    init_image_store()
+    result_path = image_store.get(image_id)
+    if result_path is not None:
+        return await image_result_response(request, image_id, result_path, w, image_format)
+    try:
+        result_path = await sd_api.get_result(image_id, timeout=result_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Image generation timed out")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Image generation failed: {e}")
     if result_path is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    images_dict[image_id] = result_path
-    with open(get_path_settings_file('images.json', new_file=True), 'w', encoding="utf-8") as f:
-        json.dump(images_dict, f)
-    return FileResponse(result_path)
+    image_store.put(image_id, result_path)
+    return await image_result_response(request, image_id, result_path, w, image_format)
+
+@http_app.get("/stats")
+async def get_stats():
+    init_sd_api()
+    return sd_api.stats()
+
+@http_app.get("/progress/{image_id}")
+async def get_progress(image_id: str):
+    init_sd_api()
+    init_image_store()
+    if not image_id in sd_api.jobs and sd_api.progress.get_latest(image_id) is None:
+        if image_store.get(image_id) is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        async def finished_stream():
+            yield f'data: {json.dumps({"state": JOB_DONE, "percent": 100.0, "image_id": image_id})}\n\n'
+        return StreamingResponse(finished_stream(), media_type='text/event-stream')
+
+    async def event_stream():
+        queue = sd_api.progress.subscribe(image_id)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield f'data: {json.dumps(event)}\n\n'
+                if event['state'] in FINISHED_STATES:
+                    break
+        finally:
+            sd_api.progress.unsubscribe(image_id, queue)
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@http_app.on_event('shutdown')
+async def close_http_client():
+    await http_client.close()
+
+async def run_mcp():
+    # Same as mcp.run() for stdio, but closes this loop's HTTP session while
+    # the loop is still running; once mcp.run() returns it is already closed.
+    try:
+        await mcp.run_stdio_async()
+    finally:
+        await http_client.close()
 
 def mcp_thread_func():
-    mcp.run()
+    try:
+        asyncio.run(run_mcp())
+    finally:
+        http_client.close_all()
 
 def uvicorn_thread_func():
     uvicorn.run(http_app, host="0.0.0.0", port=http_port, log_level='error')
@@ -1,13 +1,12 @@
 import os
 import sys
-import datetime
 import uuid
 import asyncio
-import threading
-import glob
-import gc
+import functools
+import re
+import hashlib
+import logging
 from contextlib import redirect_stdout
-from PIL import PngImagePlugin
 import aiohttp
 from diffusers import (
     StableDiffusionPipeline,
@@ -23,17 +22,71 @@ from diffusers import (
 )
 import torch
 
-from .settings import CheckPointSettings, LoraSettings
+from .settings import CheckPointSettings, LoraSettings, diff_checkpoint_settings, diff_lora_settings
+from .job_scheduler import Job, JobScheduler, QueueFullError
+from .job_registry import JobRegistry, JOB_RUNNING
+from .progress import ProgressHub
+from .latent_preview import latents_to_previews
+from .output_allocator import OutputAllocator
+from .image_writer import ImageWriter
+from .pipeline_cache import PipelineCache, PipelineCacheEntry
+from .prompt_cache import PromptEmbeddingCache
+from .model_registry import ModelRegistry, get_model_registry
+
+logger = logging.getLogger(__name__)
+
+SAMPLERS = {
+    'Euler a': EulerAncestralDiscreteScheduler,
+    'DPM++ 2M': DPMSolverMultistepScheduler,
+    'DPM++ SDE': DPMSolverSinglestepScheduler,
+    'DPM2': KDPM2DiscreteScheduler,
+    'DPM2 a': KDPM2AncestralDiscreteScheduler,
+    'Euler': EulerDiscreteScheduler,
+    'Heun': HeunDiscreteScheduler,
+    'LMS': LMSDiscreteScheduler,
+}
 
 class SDAPI_Diffusers:
-    image_threads = {}
-    image_results = {}
     checkpoint_settings = None
     lora_settings = None
     pipeline = None
+    pipeline_entry = None
 
-    def __init__(self, save_dir_path: str, checkpoints_dir_path: str | None = None, loras_dir_path: str | None = None):
+    def __init__(self, save_dir_path: str, checkpoints_dir_path: str | None = None, loras_dir_path: str | None = None, settings: dict | None = None):
+        if settings is None:
+            settings = {}
+        if save_dir_path is None:
+            save_dir_path = "sd_chat"
         self.save_dir_path = save_dir_path
+        self.output_allocator = OutputAllocator(self.save_dir_path, shard=settings.get('output_shard', None))
+        self.image_writer = ImageWriter(
+            self.output_allocator,
+            image_format=settings.get('image_format', 'png'),
+            png_compress_level=settings.get('png_compress_level', 6),
+            quality=settings.get('image_quality', 90),
+            max_workers=settings.get('image_writer_workers', 2),
+        )
+        self.jobs = JobRegistry(ttl=settings.get('job_ttl', 3600), max_finished=settings.get('max_finished_jobs', 1024))
+        self.progress = ProgressHub()
+        self.jobs.add_listener(self.progress.publish_job_state)
+        self.preview_interval = settings.get('preview_interval', 5)
+        self.scheduler = JobScheduler(
+            self.__process_jobs,
+            max_queue_size=settings.get('max_queue_size', 16),
+            max_group_streak=settings.get('max_group_streak', 4),
+            max_batch_size=settings.get('max_batch_size', 1),
+            max_batch_wait=settings.get('max_batch_wait_ms', 0) / 1000.0,
+            name='sd_chat_diffusers_worker',
+        )
+        self.pipeline_cache = PipelineCache(
+            self.__load_pipeline,
+            device='cuda',
+            device_budget_mb=settings.get('device_cache_budget_mb', None),
+            cpu_budget_mb=settings.get('cpu_cache_budget_mb', 0),
+        )
+        self.max_loaded_loras = settings.get('max_loaded_loras', 8)
+        self.transition_counts = {}
+        self.prompt_cache = PromptEmbeddingCache(max_entries=settings.get('prompt_cache_size', 64))
         if checkpoints_dir_path is None:
             self.checkpoints_dir_path = os.path.join(self.save_dir_path, 'models', 'StableDiffusion')
         else:
@@ -42,6 +95,8 @@ class SDAPI_Diffusers:
             self.loras_dir_path = os.path.join(self.save_dir_path, 'models', 'Lora')
         else:
             self.loras_dir_path = loras_dir_path
+        self.checkpoints_registry = get_model_registry(self.checkpoints_dir_path)
+        self.loras_registry = get_model_registry(self.loras_dir_path)
 
     async def get_checkpoints_dir_path(self):
         return self.checkpoints_dir_path
@@ -49,103 +104,229 @@ class SDAPI_Diffusers:
     async def get_loras_dir_path(self):
         return self.loras_dir_path
 
-    def __txt2img(self, image_id: str, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list):
-        now_str = datetime.datetime.now().strftime('%Y-%m-%d')
-
-        if self.pipeline is None or self.checkpoint_settings != checkpoint_settings or self.lora_settings != lora_settings:
-            if self.pipeline is not None:
-                del self.pipeline
-                gc.collect()
-                torch.cuda.empty_cache()
+    def __find_file(self, model_registry: ModelRegistry, name: str):
+        model_file = model_registry.resolve(name)
+        if model_file is None:
+            raise FileNotFoundError(f'Model file not found: {name} (in {model_registry.root_path})')
+        return model_file.path
 
-            self.checkpoint_settings = checkpoint_settings
-            self.lora_settings = lora_settings
+    def __load_pipeline(self, file_name: str, base_model: str):
+        if base_model == 'SD 1.5':
+            return StableDiffusionPipeline.from_single_file(
+                file_name,
+                torch_dtype=torch.float16,
+            )
+        else:
+            return StableDiffusionXLPipeline.from_single_file(
+                file_name,
+                torch_dtype=torch.float16,
+            )
 
-            target_list = glob.glob(os.path.join(self.checkpoints_dir_path, checkpoint_settings.name + '.*'))
-            for target_name in target_list:
-                if os.path.splitext(target_name)[1] == '.safetensors':
-                    file_name = target_name
+    def __set_sampler(self, entry: PipelineCacheEntry, sampler_name: str):
+        if sampler_name in SAMPLERS:
+            entry.pipeline.scheduler = SAMPLERS[sampler_name].from_config(entry.base_scheduler.config)
+        else:
+            entry.pipeline.scheduler = entry.base_scheduler
+        entry.sampler_name = sampler_name
 
-            if checkpoint_settings.base_model == 'SD 1.5':
-                self.pipeline = StableDiffusionPipeline.from_single_file(
-                    file_name,
-                    torch_dtype=torch.float16,
-                ).to("cuda")
+    def __apply_loras(self, entry: PipelineCacheEntry, lora_settings: list):
+        if lora_settings is None:
+            lora_settings = []
+        adapter_names = []
+        adapter_weights = []
+        for lora_setting_item in lora_settings:
+            lora_file_name = self.__find_file(self.loras_registry, lora_setting_item.name)
+            # Sanitizing alone can map different files (style.v1, style_v1)
+            # to one name, so the resolved path's hash keeps them apart.
+            adapter_name = re.sub(r'[^0-9A-Za-z_]', '_', lora_setting_item.name) + '_' + hashlib.sha1(lora_file_name.encode('utf-8')).hexdigest()[:8]
+            if adapter_name in entry.loaded_adapters:
+                entry.loaded_adapters.move_to_end(adapter_name)
             else:
-                self.pipeline = StableDiffusionXLPipeline.from_single_file(
-                    file_name,
-                    torch_dtype=torch.float16,
-                ).to("cuda")
-
-            if checkpoint_settings.sampler_name == 'Euler a':
-                self.pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'DPM++ 2M':
-                self.pipeline.scheduler = DPMSolverMultistepScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'DPM++ SDE':
-                self.pipeline.scheduler = DPMSolverSinglestepScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'DPM2':
-                self.pipeline.scheduler = KDPM2DiscreteScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'DPM2 a':
-                self.pipeline.scheduler = KDPM2AncestralDiscreteScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'Euler':
-                self.pipeline.scheduler = EulerDiscreteScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'Heun':
-                self.pipeline.scheduler = HeunDiscreteScheduler(self.pipeline.scheduler.config)
-            elif checkpoint_settings.sampler_name == 'LMS':
-                self.pipeline.scheduler = LMSDiscreteScheduler(self.pipeline.scheduler.config)
-
-            if lora_settings is not None and len(lora_settings) > 0:
-                adapter_names = []
-                adapter_weights = []
-                for lora_setting_item in lora_settings:
-                    target_list = glob.glob(os.path.join(self.loras_dir_path, lora_setting_item.name + '.*'))
-                    for target_name in target_list:
-                        if os.path.splitext(target_name)[1] == '.safetensors':
-                            lora_file_name = target_name
-                    self.pipeline.load_lora_weights(".", weight_name=lora_file_name, adapter_name=lora_setting_item.name)
-                    adapter_names.append(lora_setting_item.name)
-                    adapter_weights.append(lora_setting_item.weight)
-                self.pipeline.set_adapters(adapter_names, adapter_weights=adapter_weights)
-
-        generator = torch.Generator("cuda")
-        seed = generator.seed()
-
-        prompt = prompt + ", " + checkpoint_settings.prompt
-        image = self.pipeline(
-            prompt,
-            negative_prompt=checkpoint_settings.negative_prompt,
+                entry.pipeline.load_lora_weights(lora_file_name, adapter_name=adapter_name)
+                entry.loaded_adapters[adapter_name] = lora_file_name
+            adapter_names.append(adapter_name)
+            adapter_weights.append(lora_setting_item.weight)
+
+        # Keep adapters resident for later requests, but drop the least
+        # recently used ones that this request does not need.
+        evict_names = []
+        for adapter_name in entry.loaded_adapters.keys():
+            if len(entry.loaded_adapters) - len(evict_names) <= self.max_loaded_loras:
+                break
+            if not adapter_name in adapter_names:
+                evict_names.append(adapter_name)
+        if len(evict_names) > 0:
+            entry.pipeline.delete_adapters(evict_names)
+            for adapter_name in evict_names:
+                del entry.loaded_adapters[adapter_name]
+            entry.active_adapters = None
+
+        active_adapters = tuple(zip(adapter_names, adapter_weights))
+        if entry.active_adapters == active_adapters:
+            return
+        if len(adapter_names) > 0:
+            if entry.active_adapters is None or len(entry.active_adapters) <= 0:
+                entry.pipeline.enable_lora()
+            entry.pipeline.set_adapters(adapter_names, adapter_weights=adapter_weights)
+        elif len(entry.loaded_adapters) > 0:
+            entry.pipeline.disable_lora()
+        entry.active_adapters = active_adapters
+
+    def __txt2img(self, jobs: list):
+        # Every job of a batch shares the same batch key, so the first one
+        # carries the settings for all of them.
+        checkpoint_settings = jobs[0].checkpoint_settings
+        lora_settings = jobs[0].lora_settings
+
+        transitions = diff_checkpoint_settings(self.checkpoint_settings, checkpoint_settings) + diff_lora_settings(self.lora_settings, lora_settings)
+        if self.pipeline_entry is None:
+            transitions.append('weights')
+        # The new state is only recorded once every step has succeeded, so a
+        # failed setup (e.g. a missing LoRA) leaves the next job to do a
+        # full transition instead of trusting a half-switched pipeline.
+        if 'weights' in transitions:
+            self.pipeline = None
+            self.pipeline_entry = None
+            file_name = self.__find_file(self.checkpoints_registry, checkpoint_settings.name)
+            entry = self.pipeline_cache.get((file_name, checkpoint_settings.base_model), file_name, checkpoint_settings.base_model)
+        else:
+            entry = self.pipeline_entry
+
+        try:
+            if entry.sampler_name != checkpoint_settings.sampler_name:
+                self.__set_sampler(entry, checkpoint_settings.sampler_name)
+            if 'weights' in transitions or 'loras' in transitions:
+                self.__apply_loras(entry, lora_settings)
+        except Exception:
+            self.pipeline = None
+            self.pipeline_entry = None
+            self.checkpoint_settings = None
+            self.lora_settings = None
+            raise
+
+        self.pipeline_entry = entry
+        self.pipeline = entry.pipeline
+        self.checkpoint_settings = checkpoint_settings
+        self.lora_settings = lora_settings
+
+        transition_name = '+'.join(sorted(set(transitions))) if len(transitions) > 0 else 'none'
+        self.transition_counts[transition_name] = self.transition_counts.get(transition_name, 0) + 1
+        logger.info(f'{jobs[0].image_id}: pipeline transition {transition_name} ({checkpoint_settings.name}, batch of {len(jobs)})')
+
+        generators = []
+        seeds = []
+        prompt_embeds_list = []
+        pooled_prompt_embeds_list = []
+        embedding_key = (entry.key, entry.active_adapters)
+        for job in jobs:
+            generator = torch.Generator("cuda")
+            seeds.append(generator.seed())
+            generators.append(generator)
+            prompt_embeds, pooled_prompt_embeds = self.prompt_cache.get(self.pipeline, embedding_key, job.prompt + ", " + checkpoint_settings.prompt, checkpoint_settings.clip_skip)
+            prompt_embeds_list.append(prompt_embeds)
+            pooled_prompt_embeds_list.append(pooled_prompt_embeds)
+        # diffusers encodes the negative prompt without clip skip.
+        negative_prompt_embeds, negative_pooled_prompt_embeds = self.prompt_cache.get(self.pipeline, embedding_key, checkpoint_settings.negative_prompt, None)
+
+        pipeline_args = {
+            'prompt_embeds': torch.cat(prompt_embeds_list),
+            'negative_prompt_embeds': torch.cat([negative_prompt_embeds, ] * len(jobs)),
+        }
+        if negative_pooled_prompt_embeds is not None:
+            pipeline_args['pooled_prompt_embeds'] = torch.cat(pooled_prompt_embeds_list)
+            pipeline_args['negative_pooled_prompt_embeds'] = torch.cat([negative_pooled_prompt_embeds, ] * len(jobs))
+
+        images = self.pipeline(
             guidance_scale=checkpoint_settings.cfg_scale,
             num_inference_steps=checkpoint_settings.steps,
-            clip_skip=checkpoint_settings.clip_skip,
-            generator=generator,
+            generator=generators,
             width=checkpoint_settings.width,
             height=checkpoint_settings.height,
-        ).images[0]
+            callback_on_step_end=functools.partial(self.__on_step_end, jobs),
+            **pipeline_args,
+        ).images
+        logger.info(f'{jobs[0].image_id}: prompt embedding cache hit rate {self.prompt_cache.hit_rate():.2f}')
+
+        # Encoding and writing happen on the writer pool so the next batch
+        # can start on the pipeline right away.
+        for job, image, seed in zip(jobs, images, seeds):
+            infotext = self.__make_infotext(job, seed)
+            future = self.image_writer.submit(image, seed, infotext)
+            future.add_done_callback(functools.partial(self.__on_image_saved, job))
 
-        if self.save_dir_path is None:
-            self.save_dir_path = "sd_chat"
-        dir_path = os.path.join(self.save_dir_path, "txt2img", now_str)
-        os.makedirs(dir_path, exist_ok=True)
-        index = len([name for name in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, name))])
-        save_path = os.path.join(self.save_dir_path, "txt2img", now_str, f'{index:05}_{seed}.png')
+    def __on_step_end(self, jobs: list, pipeline, step_index: int, timestep, callback_kwargs: dict):
+        steps = pipeline.num_timesteps
+        step = step_index + 1
+        previews = None
+        if self.preview_interval > 0 and step % self.preview_interval == 0 and step < steps:
+            previews = latents_to_previews(callback_kwargs['latents'], isinstance(pipeline, StableDiffusionXLPipeline))
+        for index, job in enumerate(jobs):
+            event = {
+                'state': JOB_RUNNING,
+                'step': step,
+                'steps': steps,
+                'percent': step * 100.0 / steps,
+            }
+            if previews is not None:
+                event['preview'] = previews[index]
+            self.progress.publish(job.image_id, event)
+        return callback_kwargs
 
-        image.save(save_path)
+    def __make_infotext(self, job: Job, seed: int) -> str:
+        checkpoint_settings = job.checkpoint_settings
+        prompt = job.prompt + ", " + checkpoint_settings.prompt
+        if job.lora_settings is not None:
+            for lora_setting_item in job.lora_settings:
+                prompt += f', <lora:{lora_setting_item.name}:{lora_setting_item.weight}>'
+        return (
+            f'{prompt}\n'
+            f'Negative prompt: {checkpoint_settings.negative_prompt}\n'
+            f'Steps: {checkpoint_settings.steps}, Sampler: {checkpoint_settings.sampler_name}, CFG scale: {checkpoint_settings.cfg_scale}, '
+            f'Seed: {seed}, Size: {checkpoint_settings.width}x{checkpoint_settings.height}, Model: {checkpoint_settings.name}, '
+            f'Clip skip: {checkpoint_settings.clip_skip}'
+        )
 
-        del image
-        gc.collect()
-        torch.cuda.empty_cache()
+    def __on_image_saved(self, job: Job, future):
+        exception = future.exception()
+        if exception is None:
+            self.jobs.mark_done(job, future.result())
+        else:
+            self.jobs.mark_failed(job, exception)
 
-        self.image_results[image_id] = os.path.abspath(save_path)
+    def __process_jobs(self, jobs: list):
+        for job in jobs:
+            self.jobs.mark_running(job)
+        try:
+            self.__txt2img(jobs)
+        except Exception as e:
+            for job in jobs:
+                self.jobs.mark_failed(job, e)
+            raise
 
-    def start_txt2img(self, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list):
+    def start_txt2img(self, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list, priority: int = 0):
         image_id = str(uuid.uuid4())
-        self.image_threads[image_id] = threading.Thread(target=self.__txt2img, args=(image_id, prompt, checkpoint_settings, lora_settings))
-        self.image_threads[image_id].start()
+        job = Job(image_id, prompt, checkpoint_settings, lora_settings, priority)
+        self.jobs.add(job)
+        try:
+            self.scheduler.put(job)
+        except QueueFullError as e:
+            self.jobs.mark_failed(job, e)
+            raise
         return image_id
 
-    async def get_result(self, image_id):
-        if not image_id in self.image_threads:
+    def stats(self) -> dict:
+        return {
+            'jobs': self.jobs.stats(),
+            'queued': len(self.scheduler),
+            'transitions': dict(self.transition_counts),
+            'pipeline_cache': self.pipeline_cache.stats(),
+            'prompt_cache': self.prompt_cache.stats(),
+        }
+
+    async def get_result(self, image_id, timeout: float | None = None):
+        job = self.jobs.get(image_id)
+        if job is None:
             return None
-        while not image_id in self.image_results:
-            await asyncio.sleep(0.01)
-        return self.image_results[image_id]
\ No newline at end of file
+        # The future is resolved by the worker thread; shield it so a timed out
+        # waiter does not cancel the job for everyone else.
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout)
\ No newline at end of file
@@ -1,106 +1,233 @@
+import io
 import os
-import sys
-import datetime
+import time
 import uuid
+import json
+import base64
 import asyncio
-import threading
-import webuiapi
-from contextlib import redirect_stdout
-from PIL import PngImagePlugin
+import functools
 import aiohttp
+from PIL import Image
 
 from .settings import CheckPointSettings, LoraSettings
+from .job_scheduler import Job, JobScheduler, QueueFullError, make_checkpoint_group_key
+from .job_registry import JobRegistry, JOB_RUNNING
+from .progress import ProgressHub
+from .output_allocator import OutputAllocator
+from .image_writer import ImageWriter
+from .http_client import http_client, get_http_session
 
-class SDAPI_WebUIClient:
-    image_threads = {}
-    image_results = {}
+host_semaphores = {}
+
+def get_host_semaphore(host: str, port: int, max_in_flight: int) -> asyncio.Semaphore:
+    # Shared by every client talking to the same webui server.
+    key = (host, port)
+    if not key in host_semaphores:
+        host_semaphores[key] = asyncio.Semaphore(max_in_flight)
+    return host_semaphores[key]
 
+class SDAPI_WebUIClient:
     def __init__(self, save_dir_path: str | None = None, settings: dict | None = None):
-        with redirect_stdout(sys.stderr):
-            if settings is None:
-                self.api = webuiapi.WebUIApi()
-                self.url = 'http://127.0.0.1:7860/sdapi/v1'
-            else:
-                self.api = webuiapi.WebUIApi(host=settings['host'], port=settings['port'])
-                self.url = f'http://{host}:{port}/sdapi/v1'
-            self.save_dir_path = save_dir_path
+        if settings is None:
+            settings = {}
+        host = settings.get('host', '127.0.0.1')
+        port = settings.get('port', 7860)
+        self.url = f'http://{host}:{port}/sdapi/v1'
+        self.semaphore = get_host_semaphore(host, port, settings.get('max_in_flight', 2))
+        self.request_timeout = aiohttp.ClientTimeout(total=settings.get('request_timeout', 600))
+        self.checkpoints_dir_path = None
+        self.loras_dir_path = None
+        if save_dir_path is None:
+            save_dir_path = "sd_chat"
+        self.save_dir_path = save_dir_path
+        self.output_allocator = OutputAllocator(self.save_dir_path, shard=settings.get('output_shard', None))
+        self.image_writer = ImageWriter(
+            self.output_allocator,
+            image_format=settings.get('image_format', 'png'),
+            png_compress_level=settings.get('png_compress_level', 6),
+            quality=settings.get('image_quality', 90),
+            max_workers=settings.get('image_writer_workers', 2),
+        )
+        self.jobs = JobRegistry(ttl=settings.get('job_ttl', 3600), max_finished=settings.get('max_finished_jobs', 1024))
+        self.progress = ProgressHub()
+        self.jobs.add_listener(self.progress.publish_job_state)
+        self.progress_interval = settings.get('progress_interval', 0.5)
+        # Last known server state, so a job only touches the options
+        # when it needs another checkpoint.
+        self.server_checkpoint = None
+        self.server_state_time = 0.0
+        self.server_state_ttl = settings.get('server_state_ttl', 60.0)
+        # webui generates one image at a time, so jobs are taken one by one
+        # by an asyncio worker, grouped by checkpoint to amortize model
+        # switches. No thread is held while the server is generating.
+        self.scheduler = JobScheduler(
+            None,
+            max_queue_size=settings.get('max_queue_size', 16),
+            max_group_streak=settings.get('max_group_streak', 4),
+            group_key_func=make_checkpoint_group_key,
+        )
+        self.scheduler.add_listener(self.__on_job_queued)
+        self.loop = None
+        self.wake_event = None
+        self.worker_task = None
+
+    async def __request(self, method: str, path: str, payload: dict | None = None, timeout: aiohttp.ClientTimeout | None = None):
+        if timeout is None:
+            timeout = http_client.get_request_timeout()
+        async with self.semaphore:
+            async with get_http_session().request(method, self.url + path, json=payload, timeout=timeout) as response:
+                response.raise_for_status()
+                return await response.json()
 
     async def get_checkpoints_dir_path(self):
+        if self.checkpoints_dir_path is not None:
+            return self.checkpoints_dir_path
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.url + '/sd-models') as response:
-                    result = await response.json()
-                    return os.path.dirname(result[0]['filename'])
+            result = await self.__request('GET', '/sd-models')
+            self.checkpoints_dir_path = os.path.dirname(result[0]['filename'])
+            return self.checkpoints_dir_path
         except Exception:
             return None
-            
+
     async def get_loras_dir_path(self):
+        if self.loras_dir_path is not None:
+            return self.loras_dir_path
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.url + '/loras') as response:
-                    result = await response.json()
-                    return os.path.dirname(result[0]['path'])
+            result = await self.__request('GET', '/loras')
+            self.loras_dir_path = os.path.dirname(result[0]['path'])
+            return self.loras_dir_path
         except Exception:
             return None
 
-    def __txt2img(self, image_id: str, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list):
-        with redirect_stdout(sys.stderr):
-            now_str = datetime.datetime.now().strftime('%Y-%m-%d')
-
-            prev_options = self.api.get_options()
-            changed_options = {}
-            if checkpoint_settings.clip_skip != prev_options['CLIP_stop_at_last_layers']:
-                changed_options['CLIP_stop_at_last_layers'] = prev_options['CLIP_stop_at_last_layers']
-                self.api.set_options({'CLIP_stop_at_last_layers': checkpoint_settings.clip_skip})
-            if not checkpoint_settings.name in prev_options['sd_model_checkpoint']:
-                changed_options['sd_model_checkpoint'] = prev_options['sd_model_checkpoint']
-                self.api.util_set_model(checkpoint_settings.name)
-            if len(changed_options.items()) > 0:
-                self.api.util_wait_for_ready()
-
-            lora_prompt = ''
-            for lora_settings_item in lora_settings:
-                lora_prompt += f', <lora:{lora_settings_item.name}:{lora_settings_item.weight}>'
-
-            result = self.api.txt2img(
-                prompt=prompt + ", " + checkpoint_settings.prompt + lora_prompt,
-                negative_prompt=checkpoint_settings.negative_prompt,
-                cfg_scale=checkpoint_settings.cfg_scale,
-                sampler_name=checkpoint_settings.sampler_name,
-                steps=checkpoint_settings.steps,
-                width=checkpoint_settings.width,
-                height=checkpoint_settings.height,
-            )
-
-            if len(changed_options.items()) > 0:
-                self.api.set_options(changed_options)
-
-            if self.save_dir_path is None:
-                self.save_dir_path = "sd_chat"
-            dir_path = os.path.join(self.save_dir_path, "txt2img", now_str)
-            os.makedirs(dir_path, exist_ok=True)
-            index = len([name for name in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, name))])
-            seed = result.info['seed']
-            save_path = os.path.join(self.save_dir_path, "txt2img", now_str, f'{index:05}_{seed}.png')
-
-            metadata = PngImagePlugin.PngInfo()
-            metadata.add_text('parameters', result.info['infotexts'][0])
-
-            result.image.save(save_path, pnginfo=metadata)
-
-            self.image_results[image_id] = os.path.abspath(save_path)
-
-    def start_txt2img(self, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list):
-        with redirect_stdout(sys.stderr):
-            image_id = str(uuid.uuid4())
-            self.image_threads[image_id] = threading.Thread(target=self.__txt2img, args=(image_id, prompt, checkpoint_settings, lora_settings))
-            self.image_threads[image_id].start()
-            return image_id
-
-    async def get_result(self, image_id):
-        with redirect_stdout(sys.stderr):
-            if not image_id in self.image_threads:
-                return None
-            while not image_id in self.image_results:
-                await asyncio.sleep(0.01)
-            return self.image_results[image_id]
\ No newline at end of file
+    def __on_job_queued(self):
+        self.loop.call_soon_threadsafe(self.wake_event.set)
+
+    async def __worker(self):
+        while True:
+            jobs = self.scheduler.take_nowait()
+            if jobs is None:
+                self.wake_event.clear()
+                await self.wake_event.wait()
+                continue
+            for job in jobs:
+                await self.__process_job(job)
+
+    async def __process_job(self, job: Job):
+        self.jobs.mark_running(job)
+        try:
+            future = await self.__txt2img(job.image_id, job.prompt, job.checkpoint_settings, job.lora_settings)
+        except Exception as e:
+            # The server may have been changed or restarted under us.
+            self.server_checkpoint = None
+            self.jobs.mark_failed(job, e)
+            return
+        future.add_done_callback(functools.partial(self.__on_image_saved, job))
+
+    def __on_image_saved(self, job: Job, future):
+        exception = future.exception()
+        if exception is None:
+            self.jobs.mark_done(job, future.result())
+        else:
+            self.jobs.mark_failed(job, exception)
+
+    async def __poll_progress(self, image_id: str):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            try:
+                result = await self.__request('GET', '/progress?skip_current_image=false')
+            except Exception:
+                continue
+            state = result['state'] if 'state' in result else {}
+            event = {
+                'state': JOB_RUNNING,
+                'step': state['sampling_step'] if 'sampling_step' in state else 0,
+                'steps': state['sampling_steps'] if 'sampling_steps' in state else 0,
+                'percent': result['progress'] * 100.0 if 'progress' in result else 0.0,
+            }
+            if 'current_image' in result and result['current_image'] is not None:
+                event['preview'] = 'data:image/png;base64,' + result['current_image']
+            self.progress.publish(image_id, event)
+
+    async def __wait_for_ready(self, check_interval: float = 1.0):
+        deadline = time.monotonic() + self.request_timeout.total
+        while time.monotonic() < deadline:
+            result = await self.__request('GET', '/progress?skip_current_image=true')
+            if not 'state' in result or not 'job_count' in result['state'] or result['state']['job_count'] <= 0:
+                return
+            await asyncio.sleep(check_interval)
+        raise TimeoutError('webui did not become ready.')
+
+    async def __set_model(self, name: str):
+        models = await self.__request('GET', '/sd-models')
+        for model in models:
+            if name in model['title']:
+                await self.__request('POST', '/options', {'sd_model_checkpoint': model['title']}, self.request_timeout)
+                await self.__wait_for_ready()
+                return
+        raise FileNotFoundError(f'Checkpoint not found on webui: {name}')
+
+    async def __txt2img(self, image_id: str, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list):
+        if self.server_checkpoint is None or time.monotonic() - self.server_state_time > self.server_state_ttl:
+            self.server_checkpoint = (await self.__request('GET', '/options'))['sd_model_checkpoint']
+            self.server_state_time = time.monotonic()
+        if not checkpoint_settings.name in self.server_checkpoint:
+            self.server_checkpoint = None
+            await self.__set_model(checkpoint_settings.name)
+            self.server_checkpoint = (await self.__request('GET', '/options'))['sd_model_checkpoint']
+            self.server_state_time = time.monotonic()
+
+        lora_prompt = ''
+        for lora_settings_item in lora_settings:
+            lora_prompt += f', <lora:{lora_settings_item.name}:{lora_settings_item.weight}>'
+
+        payload = {
+            'prompt': prompt + ", " + checkpoint_settings.prompt + lora_prompt,
+            'negative_prompt': checkpoint_settings.negative_prompt,
+            'cfg_scale': checkpoint_settings.cfg_scale,
+            'sampler_name': checkpoint_settings.sampler_name,
+            'steps': checkpoint_settings.steps,
+            'width': checkpoint_settings.width,
+            'height': checkpoint_settings.height,
+            # Per-request values; webui restores them after the job
+            # without a separate options round trip.
+            'override_settings': {'CLIP_stop_at_last_layers': checkpoint_settings.clip_skip},
+            'override_settings_restore_afterwards': True,
+        }
+        progress_task = asyncio.create_task(self.__poll_progress(image_id))
+        try:
+            result = await self.__request('POST', '/txt2img', payload, self.request_timeout)
+        finally:
+            progress_task.cancel()
+
+        info = json.loads(result['info'])
+        # Image.open only reads the header; the image writer decodes it.
+        image = Image.open(io.BytesIO(base64.b64decode(result['images'][0])))
+        return self.image_writer.submit(image, info['seed'], info['infotexts'][0])
+
+    def start_txt2img(self, prompt: str, checkpoint_settings: CheckPointSettings, lora_settings: list, priority: int = 0):
+        # Called from the MCP server's event loop, which then runs the worker.
+        if self.worker_task is None:
+            self.loop = asyncio.get_running_loop()
+            self.wake_event = asyncio.Event()
+            self.worker_task = self.loop.create_task(self.__worker())
+        image_id = str(uuid.uuid4())
+        job = Job(image_id, prompt, checkpoint_settings, lora_settings, priority)
+        self.jobs.add(job)
+        try:
+            self.scheduler.put(job)
+        except QueueFullError as e:
+            self.jobs.mark_failed(job, e)
+            raise
+        return image_id
+
+    def stats(self) -> dict:
+        return {
+            'jobs': self.jobs.stats(),
+            'queued': len(self.scheduler),
+        }
+
+    async def get_result(self, image_id, timeout: float | None = None):
+        job = self.jobs.get(image_id)
+        if job is None:
+            return None
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout)
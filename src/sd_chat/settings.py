@@ -22,4 +22,30 @@ class CheckPointSettings(BaseModel):
     base_model: str = ''
     not_installed: bool = False
     version_id: int = -1
-    loras: Dict[str, LoraSettings] = {}
\ No newline at end of file
+    loras: Dict[str, LoraSettings] = {}
+
+# Fields of CheckPointSettings grouped by what a change to them costs.
+# Anything not listed here is a per-call parameter.
+WEIGHT_FIELDS = ('name', 'base_model')
+SAMPLER_FIELDS = ('sampler_name', )
+
+def diff_checkpoint_settings(old: CheckPointSettings | None, new: CheckPointSettings) -> List[str]:
+    if old is None:
+        return ['weights', ]
+    ret = []
+    for field_name in WEIGHT_FIELDS:
+        if getattr(old, field_name) != getattr(new, field_name):
+            ret.append('weights')
+            break
+    for field_name in SAMPLER_FIELDS:
+        if getattr(old, field_name) != getattr(new, field_name):
+            ret.append('sampler')
+            break
+    return ret
+
+def diff_lora_settings(old: List[LoraSettings] | None, new: List[LoraSettings] | None) -> List[str]:
+    old_items = [(item.name, item.weight) for item in old] if old is not None else []
+    new_items = [(item.name, item.weight) for item in new] if new is not None else []
+    if old_items != new_items:
+        return ['loras', ]
+    return []
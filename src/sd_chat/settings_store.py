@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import copy
+import time
+import threading
+
+from .settings import CheckPointSettings
+from .util import get_path_settings_file
+
+class SettingsStore:
+    def __init__(self, file_name: str = 'settings.json', check_interval: float = 1.0):
+        self.file_name = file_name
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.path = None
+        self.stat_key = None
+        self.last_check = 0.0
+        self.data = None
+        self.checkpoints = {}
+        self.checkpoint_errors = {}
+        self.version = 0
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def __notify(self, data: dict):
+        for listener in self.listeners:
+            listener(data)
+
+    def __stat(self):
+        # Only the fallback to settings_default needs re-resolving: once a
+        # writable settings file exists it stays the one we read.
+        if self.path is None or not os.path.isfile(self.path) or 'settings_default' in self.path:
+            self.path = get_path_settings_file(self.file_name)
+        stat = os.stat(self.path)
+        return (self.path, stat.st_mtime_ns, stat.st_size)
+
+    def __set_data(self, data: dict):
+        # Checkpoints whose raw dict did not change keep their validated
+        # object, so a reload only re-validates what was edited.
+        checkpoints = {}
+        checkpoint_errors = {}
+        if 'checkpoints' in data:
+            prev_checkpoints_dict = self.data['checkpoints'] if self.data is not None and 'checkpoints' in self.data else {}
+            for checkpoint_key, checkpoint_value in data['checkpoints'].items():
+                if checkpoint_key in self.checkpoints and checkpoint_key in prev_checkpoints_dict and prev_checkpoints_dict[checkpoint_key] == checkpoint_value:
+                    checkpoints[checkpoint_key] = self.checkpoints[checkpoint_key]
+                    continue
+                try:
+                    checkpoints[checkpoint_key] = CheckPointSettings(**checkpoint_value)
+                except Exception as e:
+                    # Kept out of the index, but remembered so a lookup can
+                    # report why instead of "not found".
+                    checkpoint_errors[checkpoint_key] = e
+                    print(f'Warning: invalid settings for checkpoint {checkpoint_key}: {e}', file=sys.stderr)
+        self.data = data
+        self.checkpoints = checkpoints
+        self.checkpoint_errors = checkpoint_errors
+        self.version += 1
+
+    def __refresh(self) -> bool:
+        now = time.monotonic()
+        if self.data is not None and now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+        stat_key = self.__stat()
+        if stat_key == self.stat_key:
+            return False
+        with open(self.path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        self.stat_key = stat_key
+        self.__set_data(data)
+        return True
+
+    def get(self) -> dict:
+        # The returned dict is shared between callers; use load_for_update()
+        # to get a copy that can be modified and saved.
+        with self.lock:
+            changed = self.__refresh()
+            data = self.data
+        if changed:
+            self.__notify(data)
+        return data
+
+    def get_checkpoint_settings(self, checkpoint_key: str) -> CheckPointSettings | None:
+        self.get()
+        return self.checkpoints.get(checkpoint_key)
+
+    def get_checkpoint_error(self, checkpoint_key: str) -> Exception | None:
+        self.get()
+        return self.checkpoint_errors.get(checkpoint_key)
+
+    def load_for_update(self) -> dict:
+        return copy.deepcopy(self.get())
+
+    def save(self, data: dict):
+        with self.lock:
+            path = get_path_settings_file(self.file_name, new_file=True)
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w', encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp_path, path)
+            self.path = path
+            self.stat_key = self.__stat()
+            self.last_check = time.monotonic()
+            self.__set_data(copy.deepcopy(data))
+            data = self.data
+        self.__notify(data)
+
+settings_store = SettingsStore()
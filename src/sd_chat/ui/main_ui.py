@@ -1,10 +1,10 @@
 import os
 import json
 import logging
-import aiohttp
 import gradio as gr
 
 from ..util import get_path_settings_file
+from ..http_client import http_client, get_http_session
 
 settings_dict = {}
 
@@ -56,9 +56,8 @@ async def ui_init_chat_model_names(chat_api, chat_api_url, chat_api_api_key):
     if chat_api == 'OpenAI API':
         chat_api_url = 'https://api.openai.com/v1'
     headers = {"Authorization": f"Bearer {chat_api_api_key}"}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(chat_api_url + '/models') as response:
-            response_dict = await response.json()
+    async with get_http_session().get(chat_api_url + '/models', headers=headers, timeout=http_client.get_request_timeout()) as response:
+        response_dict = await response.json()
     ret_list = []
     for model_dict in response_dict['data']:
         ret_list.append(model_dict['id'])
@@ -494,7 +493,10 @@ def main_ui(platform='standalone'):
 def main():
     runner_interface = main_ui()
     runner_interface.queue()
-    runner_interface.launch(server_port=50081)
+    try:
+        runner_interface.launch(server_port=50081)
+    finally:
+        http_client.close_all()
 
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
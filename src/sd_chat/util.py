@@ -62,4 +62,15 @@ def get_path_settings_file(file_name: str, new_file=False, sd_webui_extensions=F
             if os.path.isfile(ret):
                 return ret
 
-    return None
\ No newline at end of file
+    return None
+def get_path_data_file(file_name: str):
+    # Databases and caches live next to the settings file. Unlike
+    # get_path_settings_file, --settings_file never stands in for them.
+    global args
+    if args.settings_file is not None:
+        settings_path = args.settings_file
+    else:
+        settings_path = get_path_settings_file('settings.json', new_file=True)
+    ret = os.path.join(os.path.dirname(os.path.abspath(settings_path)), file_name)
+    os.makedirs(os.path.dirname(ret), exist_ok=True)
+    return ret